@@ -12,27 +12,155 @@ import uasyncio as asyncio
 import ujson as json
 import ulogging as logging
 from umqtt.robust import MQTTClient
+from umqtt.simple import MQTTClient as SimpleMQTTClient
+
+from . import ringbuffer
+from .spool import LogSpool
+from .concurrency import SPSCQueue
+from .network_manager import NetworkManager
+from .profiling import BootTimeline
+from .memory import MemoryManager, largest_free_block
+from .metrics import Metrics, BOUNDS_MS
+from .scheduler import Scheduler, ServiceHung
+from .ota_updater import OTAUpdater, HttpClient, HttpCache, AsyncHttpClient, check_bytecode
+from .peer import PeerSeeder, PeerReceiver, make_manifest
+
+
+def _load_env(path):
+    # A reset between the remove and the rename in `write_env` leaves only
+    # the new env, complete, in `<path>.tmp`; finish the rename
+    try:
+        f = open(path, 'r')
+    except OSError:
+        os.rename(path + '.tmp', path)
+        f = open(path, 'r')
+    with f:
+        return json.load(f)
 
-from .ota_updater import OTAUpdater
 
 try:
-    env = json.load(open('envs/env.json', 'r'))
+    env = _load_env('envs/env.json')
 except OSError:
     print('You must create an env.json file.')
 
 
 wifi = network.WLAN(network.STA_IF)
-_command_queue = []
+# Commands received by the MQTT callback, waiting to be run
+_command_queue = SPSCQueue(16)
+# Decides when to collect garbage; configured from the env by the supervisor
+_memory = MemoryManager()
+# Runtime counters, see `Service.metrics`
+_metrics = Metrics()
+# Watches how long services run without yielding; configured from the env
+# by the supervisor
+_scheduler = Scheduler()
 _startup_time = None
+_startup_time_lock = _thread.allocate_lock()
+# `NetworkManager` keeping wifi connected once the supervisor is running
+_network = None
+
+# Exact MQTT topic (bytes) -> callback(topic, message), used to dispatch
+# incoming messages without parsing the topic
+_topic_handlers = {}
+# (topic filter split into levels, callback) for filters with `+` or `#`,
+# tried in order when no exact topic matches
+_wildcard_handlers = []
+# Topics to (re)subscribe to on every connection, besides commands
+_subscriptions = []
+_mqtt = None
+
+# Release bundles served to or fetched from peers (see `_init_peer_updates`)
+_PEER_DIRECTORY = '.peer_updates'
+
+
+def subscribe(topic, callback):
+    # Call `callback(topic, message)` for messages published to `topic`,
+    # which may contain the wildcards `+` and `#`
+    if '+' in topic or '#' in topic:
+        levels = topic.encode().split(b'/')
+        for i, (pattern, handler) in enumerate(_wildcard_handlers):
+            if pattern == levels:
+                _wildcard_handlers[i] = (levels, callback)
+                break
+        else:
+            _wildcard_handlers.append((levels, callback))
+    else:
+        _topic_handlers[topic.encode()] = callback
+    if topic not in _subscriptions:
+        _subscriptions.append(topic)
+        if _mqtt is not None:
+            try:
+                _mqtt.subscribe(topic)
+            except Exception:
+                # Subscribed on the next (re)connect
+                pass
+
+
+def _topic_matches(pattern, topic):
+    # `pattern` is a topic filter split into levels
+    levels = topic.split(b'/')
+    for i, level in enumerate(pattern):
+        if level == b'#':
+            return True
+        if i >= len(levels) or (level != b'+' and level != levels[i]):
+            return False
+    return len(levels) == len(pattern)
+
+# Parsed `envs/<module>/env.json` files, so reading `env` doesn't hit the
+# filesystem. The dicts are shared: treat them as read-only and change them
+# with `set_env`/`update_env`.
+_env_cache = {}
+# Module name -> service to notify when its env changes
+_env_listeners = {}
+
+
+def _env_path(module_name=None):
+    if module_name:
+        return 'envs/%s/env.json' % module_name.split('.')[-1]
+    return 'envs/env.json'
+
 
 def get_env(module_name=None):
+    if not module_name:
+        return env
+    module_name = module_name.split('.')[-1]
     try:
-        if module_name:
-            return json.load(open('envs/%s/env.json' % module_name.split('.')[-1], 'r'))
-        else:
-            return env
+        return _env_cache[module_name]
+    except KeyError:
+        pass
+    try:
+        module_env = _load_env(_env_path(module_name))
+    except OSError:
+        module_env = {}
+    _env_cache[module_name] = module_env
+    return module_env
+
+
+def write_env(new_env, module_name=None):
+    # Write to a temporary file and rename it over the old one, so a reset
+    # during the write can't leave a corrupt env.json behind
+    global env
+    path = _env_path(module_name)
+    with open(path + '.tmp', 'w') as f:
+        f.write(json.dumps(new_env))
+    try:
+        os.rename(path + '.tmp', path)
     except OSError:
-        return {}
+        # Some filesystems (e.g. FAT) won't rename over an existing file
+        os.remove(path)
+        os.rename(path + '.tmp', path)
+
+    if not module_name:
+        env = new_env
+        return
+    module_name = module_name.split('.')[-1]
+    _env_cache.pop(module_name, None)
+    service = _env_listeners.get(module_name)
+    if service is not None:
+        try:
+            service._on_env_changed(get_env(module_name))
+        except Exception as e:
+            sys.print_exception(e)
 
 
 def requires_network(func):
@@ -45,7 +173,7 @@ def requires_network(func):
             # Wait for the connection to be established
             start_time = time.time()
             while not wifi.isconnected() and time.time() - start_time < 5:
-                pass
+                time.sleep_ms(100)
 
             if wifi.isconnected():
                 print('Network config:', wifi.ifconfig())
@@ -58,72 +186,234 @@ def requires_network(func):
     return wrapper
 
 
+def requires_network_async(func):
+    # Like `requires_network`, but waits for the `NetworkManager` to connect
+    # without blocking the event loop
+    async def wrapper(*args, **kwargs):
+        if not wifi.isconnected():
+            if _network is None or not await _network.wait_connected(5):
+                print('Can\'t connect to network resource.')
+                return None
+        return func(*args, **kwargs)
+    return wrapper
+
+
+# `write` can be called from any thread, so the log task is woken with a
+# ThreadSafeFlag where the firmware has one
+_THREADSAFE_WAKEUP = hasattr(asyncio, 'ThreadSafeFlag')
+
+
+def _readable(sock):
+    # Suspend the calling task until `sock` has data to read, using the
+    # uasyncio poller instead of waking up periodically to check
+    yield asyncio.core._io_queue.queue_read(sock)
+
+
+class _MQTTClient(MQTTClient):
+    # Called after every successful (re)connect
+    on_connect = None
+
+    def connect(self, clean_session=True):
+        result = super().connect(clean_session)
+        if self.on_connect is not None:
+            self.on_connect()
+        return result
+
+    def reconnect(self):
+        # `umqtt.robust` reconnects by itself when publishing or receiving
+        # fails, without going through `connect` above
+        result = super().reconnect()
+        if self.on_connect is not None:
+            self.on_connect()
+        return result
+
+    # Counts what is published, for the metrics
+    def publish(self, topic, msg, retain=False, qos=0):
+        super().publish(topic, msg, retain, qos)
+        _metrics.published += 1
+        _metrics.published_bytes += len(msg)
+
+    def publish_once(self, topic, msg, retain=False, qos=0):
+        # Raises when the connection is down instead of reconnecting and
+        # retrying (blocking the caller) like `publish`
+        SimpleMQTTClient.publish(self, topic, msg, retain, qos)
+        _metrics.published += 1
+        _metrics.published_bytes += len(msg)
+
+    def check_msg_once(self):
+        # Same for `check_msg`
+        self.sock.setblocking(False)
+        return SimpleMQTTClient.wait_msg(self)
+
+
 # https://github.com/micropython/micropython/pull/3836
 # https://docs.micropython.org/en/latest/library/uio.html
 class MQTTStream(io.IOBase):
-    def __init__(self, client, client_id, print_output=True):
+    def __init__(self, client, client_id, print_output=True, buffer_size=4096,
+                 overflow=ringbuffer.DROP_OLDEST, batch_bytes=1024, batch_ms=1000,
+                 spool=None, replay_rate=10, max_lines=None):
         self.client = client
+        # Log messages are published without retrying, so that a broker
+        # outage takes the stream offline (and to the spool) instead of
+        # blocking the event loop; `Service.loop` reconnects
+        self._publish_once = getattr(client, 'publish_once', None)
+        if self._publish_once is None:
+            self._publish_once = lambda topic, msg: SimpleMQTTClient.publish(client, topic, msg)
         self.id = client_id
         self.print_output = print_output
-        self.buf = ''
+        # Bounded buffer of log output waiting to be published, so a stalled
+        # broker can't exhaust the heap
+        self._ring = ringbuffer.RingBuffer(buffer_size, max_lines, overflow)
         self.service = ''
+        # Lines are published per topic as one JSON array, once `batch_bytes`
+        # of records are waiting or the oldest has waited `batch_ms`. Set
+        # `batch_bytes` to 0 to publish each line as its own message.
+        self.batch_bytes = batch_bytes
+        self.batch_ms = batch_ms
+        self._batches = {}
+        self._batch_size = 0
+        self._batch_started = 0
+        self._utc_second = None
+        self._utc_time = ''
+        # Optional `LogSpool` that keeps messages we fail to publish until the
+        # broker is reachable again. They are replayed at up to `replay_rate`
+        # messages per 100 ms alongside live traffic.
+        self._spool = spool
+        self.replay_rate = replay_rate
+        self._offline = False
+        self._replaying = spool is not None and spool.pending()
+        # Wakes the log task when a complete line has been written
+        self._wakeup = asyncio.ThreadSafeFlag() if _THREADSAFE_WAKEUP else asyncio.Event()
         super().__init__()
 
-    def write(self, buf):
-        lock = _thread.allocate_lock()
-        
-        with lock:
-            try:
-                self.buf += buf
-            except TypeError:
-                self.buf += buf.decode('utf-8')
+    @property
+    def dropped_lines(self):
+        return self._ring.dropped_lines
 
-            return len(buf)
+    def write(self, buf):
+        self._ring.write(buf)
+        if self._ring.lines:
+            self._wakeup.set()
+        return len(buf)
+
+    def _get_utc_time(self, now):
+        # Only format the timestamp once per second
+        if now != self._utc_second:
+            self._utc_second = now
+            if _startup_time:
+                self._utc_time = '%d-%02d-%02dT%02d:%02d:%02d' % time.localtime(now + _startup_time)[:6]
+            else:
+                self._utc_time = ''
+        return self._utc_time
+
+    def _process_line(self, line):
+        uptime = time.time()
+        utc_time = self._get_utc_time(uptime)
+
+        parts = line.split(':', 2)
+        if len(parts) == 3:
+            level, self.service, message = parts
+            record = {'utc_time': utc_time,
+                      'level': level,
+                      'uptime': uptime,
+                      'message': message}
+            topic = '%s/%s/logging' % (self.id, self.service)
+            if self.print_output:
+                print('[%s] %s - %s - %s - %s' % (self.service, utc_time, uptime, level, message))
+        else: # Traceback
+            record = {'message': line}
+            topic = '%s/%s/exceptions' % (self.id, self.service)
+            if self.print_output:
+                print(line)
+
+        if not self.batch_bytes:
+            self._publish(topic, json.dumps(record))
+            return
+
+        if not self._batches:
+            self._batch_started = time.ticks_ms()
+        if topic in self._batches:
+            self._batches[topic].append(record)
+        else:
+            self._batches[topic] = [record]
+        # Approximate size of the record once serialized
+        self._batch_size += len(line) + 48
+
+        if self._batch_size >= self.batch_bytes:
+            self._flush()
+
+    def _flush(self):
+        batches = self._batches
+        self._batches = {}
+        self._batch_size = 0
+        for topic, records in batches.items():
+            self._publish(topic, json.dumps(records))
+
+    def _publish(self, topic, message):
+        if self._offline and self._spool is not None:
+            self._spool.append(topic, message)
+            return
+        try:
+            self._publish_once(topic, message)
+        except Exception as e:
+            print(e)
+            sys.print_exception(e, sys.stderr)
+            if self._spool is not None:
+                self._spool.append(topic, message)
+                self._offline = True
+                self._replaying = True
+
+    def resume(self):
+        # Called once the MQTT connection is back up
+        self._offline = False
+
+    def _replay_spool(self):
+        try:
+            if self._spool.replay(self._publish_once, self.replay_rate) < self.replay_rate:
+                self._replaying = False
+        except Exception as e:
+            print(e)
+            self._offline = True
 
     async def _process_log_queue(self):
+        self._ring.consumer = _thread.get_ident()
         while True:
-            gc.collect()
-            
-            lock = _thread.allocate_lock()
-            
-            with lock:
-                # Send mqtt messages when we recieve a newline
-                while self.buf.find('\n') != -1:
-                    newline = self.buf.find('\n')
-                    line = self.buf[:newline]
-                    self.buf = self.buf[newline + 1:]
-
-                    if _startup_time:
-                        utc_time = '%d-%02d-%02dT%02d:%02d:%02d' % time.localtime(time.time() + _startup_time)[:6]
-                    else:
-                        utc_time = ''
-
-                    uptime = time.time()
-
-                    if len(line.split(':')) >= 3:
-                        level, self.service = line.split(':')[:2]
-                        message = json.dumps({'utc_time': utc_time,
-                                            'level': level,
-                                            'uptime': uptime,
-                                            'message': ''.join(line.split(':')[2:])})
-                        print_message = '[%s] %s - %s - %s - %s' % (self.service, utc_time, uptime, level, message)
-                        topic = '%s/%s/logging' % (self.id, self.service)
-                    else: # Traceback
-                        message = json.dumps({'message': line})
-                        print_message = line
-                        topic = '%s/%s/exceptions' % (self.id, self.service)
-
-                    try:
-                        self.client.publish(topic, message)
-                    except Exception as e:
-                        print(e)
-                        sys.print_exception(e, sys.stderr)
-
-                    # Also print to stdout?
-                    if self.print_output:
-                        print(print_message)
-
-            await asyncio.sleep(0.1)
+            _memory.maybe_collect()
+
+            # Send mqtt messages for each complete line
+            while True:
+                with self._ring.lock:
+                    line = self._ring.peekline()
+                    if line is None:
+                        break
+                    line = str(line, 'utf-8')
+                    self._ring.consume()
+                self._process_line(line)
+
+            if (self._batches and
+                    time.ticks_diff(time.ticks_ms(), self._batch_started) >= self.batch_ms):
+                self._flush()
+
+            if self._replaying and not self._offline:
+                self._replay_spool()
+
+            if self._replaying and not self._offline:
+                await asyncio.sleep_ms(100)
+            elif self._batches:
+                # Keep draining the buffer as lines come in until the batch
+                # is due, so a busy writer doesn't fill it up meanwhile
+                elapsed = time.ticks_diff(time.ticks_ms(), self._batch_started)
+                try:
+                    await asyncio.wait_for_ms(self._wakeup.wait(), max(0, self.batch_ms - elapsed))
+                except asyncio.TimeoutError:
+                    pass
+                if not _THREADSAFE_WAKEUP:
+                    self._wakeup.clear()
+            else:
+                # Nothing to do until `write` completes a line
+                await self._wakeup.wait()
+                if not _THREADSAFE_WAKEUP:
+                    self._wakeup.clear()
 
 
 class BaseService():
@@ -134,6 +424,9 @@ class BaseService():
     def __init__(self):
         self.name = self.__class__.__module__.split('.')[-1]
         self._asyncio_loop = asyncio.get_event_loop()
+        # Guards `_state`, which is read from the asyncio thread and written
+        # by remote commands and the main thread
+        self._lock = _thread.allocate_lock()
         self._state = 'stopped'
         self._task = self.main()
         self._asyncio_loop.create_task(self._task)
@@ -141,17 +434,19 @@ class BaseService():
         
         # Inspect class to get methods and members
         type(self)._methods = [x for x in dir(self.__class__)
-                               if eval('callable(%s.Service.%s)' % 
-                                       (self.name, x))
-                                    and not x.startswith('_')]
+                               if not x.startswith('_')
+                                    and callable(getattr(self.__class__, x))]
         type(self)._vars = [x for x in dir(self.__class__)
                             if x not in self._methods
                                 and not x.startswith('_')]
 
+        # Remote commands are dispatched through this table of bound methods,
+        # resolved once here rather than on every call
+        self._dispatch = {x: getattr(self, x) for x in self._methods}
+
     @property
     def state(self):
-        lock = _thread.allocate_lock()
-        with lock:
+        with self._lock:
             state = self._state
         return state
 
@@ -172,35 +467,51 @@ class BaseService():
 
     def start(self):
         self._logger.info('Starting %s.' % self.name)
-        lock = _thread.allocate_lock()
-        with lock:
+        with self._lock:
             self._state = 'running'
 
     def stop(self):
         self._logger.info('Stopping %s.' % self.name)
-        lock = _thread.allocate_lock()
-        with lock:
+        with self._lock:
             self._state = 'stopped'
     
+    def subscribe(self, channel, callback):
+        # Call `callback(topic, message)` for messages published to
+        # `<hardware_id>/<service name>/<channel>`
+        subscribe('%s/%s/%s' % (self.hardware_id, self.name, channel), callback)
+
     def get_env(self, module=None):
         return get_env(module)
 
     def set_env(self, new_env, module=None):
-        with open('envs/%s/env.json' % module, 'w') as f:
-            f.write(json.dumps(new_env))
+        write_env(new_env, module)
         return self.get_env(module)
 
     def update_env(self, update_env, module=None):
-        env_dict = get_env(module)
+        env_dict = dict(get_env(module))
         env_dict.update(update_env)
-        with open('envs/%s/env.json' % module, 'w') as f:
-            f.write(json.dumps(env_dict))
+        write_env(env_dict, module)
         return self.get_env(module)
 
+    # Called after this service's env has been changed (e.g. remotely)
+    def _on_env_changed(self, env):
+        pass
+
     async def main(self):
+        stats = _metrics.service(self.name)
         while True:
             if self.state == 'running':
-                await self.loop()
+                try:
+                    await stats.timed(self.loop(), _scheduler)
+                except ServiceHung as e:
+                    self._logger.error('%s, restarting it.' % e)
+                    self.stop()
+                    self.start()
+                except Exception as e:
+                    # Don't let one failed `loop()` end the service for good
+                    self._logger.error('loop() failed, restarting it: %s' % repr(e))
+                    await asyncio.sleep(1)
+                await _scheduler.throttle(self.name)
             else:
                 await asyncio.sleep(1)
 
@@ -214,38 +525,127 @@ class BaseService():
 class Service(BaseService):
     # Setup
     def __init__(self):
+        # Time and heap use of each startup phase
+        self._boot = BootTimeline()
         super().__init__()
         self.mqtt = None
         self._log_stream = None
         self._asyncio_loop = asyncio.get_event_loop()
         self._services = {}
-        self._init_mqtt()
-        self._mqtt_connect()
-        self._init_logging()
-        self._get_updates()
+        # Service -> (PeerSeeder, task) and PeerReceiver
+        self._seeders = {}
+        self._receivers = {}
+        self._init_memory()
+        with self._boot.phase('init_network'):
+            self._init_network()
+        with self._boot.phase('init_mqtt'):
+            self._init_mqtt()
+        with self._boot.phase('mqtt_connect'):
+            self._mqtt_connect()
+        with self._boot.phase('init_logging'):
+            self._init_logging()
+        with self._boot.phase('init_peer_updates'):
+            self._init_peer_updates()
+
+        # By default, start services right away and check for updates in the
+        # background
+        UPDATE_IN_BACKGROUND = env['UPDATE_IN_BACKGROUND'] if 'UPDATE_IN_BACKGROUND' in env.keys() else True
+        if not UPDATE_IN_BACKGROUND:
+            with self._boot.phase('get_updates'):
+                self._get_updates()
+
+        # Install updates downloaded in the background before the last reset
+        # (only with `UPDATE_INSTALL` set to 'deferred')
+        with self._boot.phase('apply_pending_updates'):
+            self._apply_pending_updates()
+
         self._init_services()
-        self.start_all_services()
+        with self._boot.phase('start_all_services'):
+            self.start_all_services()
+        # Publish from this thread while the loop isn't running yet, so the
+        # two don't use the MQTT socket at the same time
+        self._publish_boot_timeline()
         self._asyncio_loop.create_task(self._update_ntp())
+        self._init_metrics()
+        self._init_scheduler()
+
+        if UPDATE_IN_BACKGROUND:
+            self._asyncio_loop.create_task(self._get_updates_async())
+
+        # Last: the loop's task queue isn't thread-safe, so every task above
+        # must be created before the loop runs in another thread
+        self._start_asyncio_loop()
+
+    def _init_memory(self):
+        # Collect once GC_BUDGET bytes were allocated since the last
+        # collection or less than GC_WATERMARK bytes are free; MicroPython
+        # collects by itself after GC_THRESHOLD bytes. Defaults scale with
+        # the heap (see `MemoryManager`).
+        GC_BUDGET = env['GC_BUDGET'] if 'GC_BUDGET' in env.keys() else None
+        GC_WATERMARK = env['GC_WATERMARK'] if 'GC_WATERMARK' in env.keys() else None
+        GC_THRESHOLD = env['GC_THRESHOLD'] if 'GC_THRESHOLD' in env.keys() else None
+        _memory.configure(GC_BUDGET, GC_WATERMARK, GC_THRESHOLD)
+
+    def _init_network(self):
+        global _network
+        WIFI_BACKOFF_MIN = env['WIFI_BACKOFF_MIN'] if 'WIFI_BACKOFF_MIN' in env.keys() else 1
+        WIFI_BACKOFF_MAX = env['WIFI_BACKOFF_MAX'] if 'WIFI_BACKOFF_MAX' in env.keys() else 60
+        _network = NetworkManager(wifi, env['WIFI_SSID'], env['WIFI_PASSWORD'],
+                                  min_backoff=WIFI_BACKOFF_MIN,
+                                  max_backoff=WIFI_BACKOFF_MAX)
+        self._asyncio_loop.create_task(_network.run())
 
     def _init_mqtt(self):
         MQTT_USER = env['MQTT_USER'] if 'MQTT_USER' in env.keys() else None
         MQTT_PASSWORD = env['MQTT_PASSWORD'] if 'MQTT_PASSWORD' in env.keys() else None
 
         # Create an mqtt client
-        self.mqtt = MQTTClient(self.hardware_id,
+        self.mqtt = _MQTTClient(self.hardware_id,
                                env['MQTT_HOST'],
                                user=MQTT_USER,
                                password=MQTT_PASSWORD)
 
         self.mqtt.set_callback(self._mqtt_callback)
 
+        global _mqtt
+        _mqtt = self.mqtt
+
     def _init_logging(self):
         LOG_LOCALLY = env['LOG_LOCALLY'] if 'LOG_LOCALLY' in env.keys() else True
+        LOG_BUFFER_SIZE = env['LOG_BUFFER_SIZE'] if 'LOG_BUFFER_SIZE' in env.keys() else 4096
+        # Most complete lines the buffer holds; by default one per 32 bytes
+        LOG_BUFFER_LINES = env['LOG_BUFFER_LINES'] if 'LOG_BUFFER_LINES' in env.keys() else None
+        # One of 'drop_oldest', 'drop_newest' or 'block'
+        LOG_OVERFLOW = env['LOG_OVERFLOW'] if 'LOG_OVERFLOW' in env.keys() else ringbuffer.DROP_OLDEST
+        # Publish log lines in batches of up to LOG_BATCH_BYTES (0 disables
+        # batching), waiting at most LOG_BATCH_MS
+        LOG_BATCH_BYTES = env['LOG_BATCH_BYTES'] if 'LOG_BATCH_BYTES' in env.keys() else 1024
+        LOG_BATCH_MS = env['LOG_BATCH_MS'] if 'LOG_BATCH_MS' in env.keys() else 1000
+
+        # Optionally keep log messages on flash while the broker is unreachable
+        LOG_SPOOL = env['LOG_SPOOL'] if 'LOG_SPOOL' in env.keys() else False
+        LOG_SPOOL_SEGMENT_SIZE = env['LOG_SPOOL_SEGMENT_SIZE'] if 'LOG_SPOOL_SEGMENT_SIZE' in env.keys() else 4096
+        LOG_SPOOL_SEGMENTS = env['LOG_SPOOL_SEGMENTS'] if 'LOG_SPOOL_SEGMENTS' in env.keys() else 8
+        LOG_SPOOL_REPLAY_RATE = env['LOG_SPOOL_REPLAY_RATE'] if 'LOG_SPOOL_REPLAY_RATE' in env.keys() else 10
+        log_spool = None
+        if LOG_SPOOL:
+            log_spool = LogSpool(segment_size=LOG_SPOOL_SEGMENT_SIZE,
+                                 segments=LOG_SPOOL_SEGMENTS)
+
         self._log_stream = MQTTStream(self.mqtt,
                                       self.hardware_id,
-                                      LOG_LOCALLY)
+                                      LOG_LOCALLY,
+                                      LOG_BUFFER_SIZE,
+                                      LOG_OVERFLOW,
+                                      LOG_BATCH_BYTES,
+                                      LOG_BATCH_MS,
+                                      log_spool,
+                                      LOG_SPOOL_REPLAY_RATE,
+                                      LOG_BUFFER_LINES)
 
         self._asyncio_loop.create_task(self._log_stream._process_log_queue())
+        # However the client got reconnected, publish (and replay) logs again
+        self.mqtt.on_connect = self._log_stream.resume
 
         # Set the log level based on the global environment variable 'LOG_LEVEL'
         log_level_string = env['LOG_LEVEL'] if 'LOG_LEVEL' in env.keys() else 'DEBUG'
@@ -254,7 +654,7 @@ class Service(BaseService):
         LOG_LEVEL = logging.DEBUG
         for x in ['DEBUG', 'INFO', 'WARNING', 'ERROR']:
             if x == log_level_string:
-                LOG_LEVEL = eval('logging.%s' % x)
+                LOG_LEVEL = getattr(logging, x)
                 break
 
         # Make this the default log stream
@@ -264,46 +664,90 @@ class Service(BaseService):
 
     @staticmethod
     def _mqtt_callback(topic, message):
-        topic_path = topic.decode('utf-8').split('/')[1:]
-        service, channel = topic_path
-        
-        # Command router
-        if channel == 'commands':
-            message = json.loads(message)
-            _command_queue.append((service, message))
+        handler = _topic_handlers.get(topic)
+        if handler is None:
+            for pattern, callback in _wildcard_handlers:
+                if _topic_matches(pattern, topic):
+                    handler = callback
+                    break
+        if handler is not None:
+            handler(topic, message)
 
     async def _process_mqtt_messages(self):
         while True:
+            sock = self.mqtt.sock
+            if sock is None:
+                # Not connected; `loop()` takes care of reconnecting
+                await asyncio.sleep(1)
+                continue
+
+            # Wait for incoming data instead of polling. Neither receiving nor
+            # responding reconnects, which would block the event loop until
+            # the broker is back; `loop()` takes care of that.
+            await _readable(sock)
             try:
-                self.mqtt.check_msg()
+                self.mqtt.check_msg_once()
             except:
-                pass
-            await asyncio.sleep(0.1)
+                # Don't spin on a broken socket until it's reconnected
+                await asyncio.sleep(1)
 
-            while len(_command_queue):
-                service, message = _command_queue.pop(0)
-                args = message['args'] if 'args' in message.keys() else ''
-                command = 'service.%s(%s)' % (message['command'], args)
-                
-                # Include `command`, `token`, and `args`, in the response
-                response = {'command': message['command'],
-                            'token': message['token'],
-                            'args': args}
-
-                if message['command'] in self._services[service]._methods:
-                    try:
-                        response['response'] = eval(command, globals(), {'service': self._services[service]})
-                    except Exception as e:
-                        response['exception'] = repr(e)
-                        self._logger.error('Remote command ("%s") caused an exception.' % command)
-                        sys.print_exception(e, self._log_stream)
+            while True:
+                item = _command_queue.get()
+                if item is None:
+                    break
+                service, message, received = item
+
+                if not isinstance(message, dict):
+                    response = {'exception': 'A command must be a JSON object.'}
+                elif 'commands' in message.keys():
+                    # Batch of commands, answered with a single response
+                    commands = message['commands']
+                    if isinstance(commands, list):
+                        response = {'responses': [self._run_command(service, command)
+                                                  for command in commands]}
+                    else:
+                        response = {'exception': '"commands" must be a list.'}
+                    response['token'] = message.get('token')
                 else:
-                    response['exception'] = 'The specified command is not available.'
-                    self._logger.error('Remote command ("%s") caused an exception.' % command)
-
-                self.mqtt.publish('%s/%s/responses' % (self.hardware_id, service), json.dumps(response))
+                    response = self._run_command(service, message)
+                    response['token'] = message.get('token')
 
-            gc.collect()
+                try:
+                    self.mqtt.publish_once('%s/%s/responses' % (self.hardware_id, service), json.dumps(response))
+                except Exception as e:
+                    self._logger.error("Couldn't respond to a remote command: %s" % repr(e))
+                    continue
+                _metrics.command_latency.record(time.ticks_diff(time.ticks_ms(), received))
+
+            _memory.maybe_collect()
+
+    def _run_command(self, service, message):
+        # `args` is a JSON list and `kwargs` a JSON object. For compatibility,
+        # `args` may also be a string of comma-separated JSON values.
+        if not isinstance(message, dict) or not isinstance(message.get('command'), str):
+            self._logger.error('Malformed remote command: %s' % repr(message))
+            return {'exception': 'A command must be a JSON object with a "command".'}
+        args = message['args'] if 'args' in message.keys() else []
+        kwargs = message['kwargs'] if 'kwargs' in message.keys() else {}
+
+        # Include `command` and `args` in the response
+        response = {'command': message['command'],
+                    'args': args}
+
+        method = self._services[service]._dispatch.get(message['command'])
+        if method is not None:
+            try:
+                if isinstance(args, str):
+                    args = json.loads('[%s]' % args)
+                response['response'] = method(*args, **kwargs)
+            except Exception as e:
+                response['exception'] = repr(e)
+                self._logger.error('Remote command ("%s") caused an exception.' % message['command'])
+                sys.print_exception(e, self._log_stream)
+        else:
+            response['exception'] = 'The specified command is not available.'
+            self._logger.error('Remote command ("%s") caused an exception.' % message['command'])
+        return response
 
     async def _update_ntp(self):
         def update():
@@ -311,8 +755,7 @@ class Service(BaseService):
             try:
                 self._logger.info('Get NTP time')
                 
-                lock = _thread.allocate_lock()
-                with lock:
+                with _startup_time_lock:
                     _startup_time = ntptime.time() - time.time()
 
                 self._logger.info('_startup_time=%s' % _startup_time)
@@ -324,13 +767,13 @@ class Service(BaseService):
         while not _startup_time:
             update()
             await asyncio.sleep(10)
-            gc.collect()
+            _memory.maybe_collect()
 
         # Afterwords, sync once per day
         while True:
             await asyncio.sleep(60*60*24)
             update()
-            gc.collect()
+            _memory.maybe_collect()
 
     @requires_network
     def _wifi_connect(self):
@@ -338,43 +781,349 @@ class Service(BaseService):
 
     @requires_network
     def _mqtt_connect(self):
-        self.mqtt.connect()
-        self.mqtt.subscribe('%s/#' % self.hardware_id)
+        self._connect_mqtt()
 
-    @requires_network
-    def _get_updates(self):
-        reboot_flag = False
+    @requires_network_async
+    def _mqtt_connect_async(self):
+        self._connect_mqtt()
+
+    def _connect_mqtt(self):
+        self.mqtt.connect()
+        # Only commands; subscribing to everything under our id would echo
+        # back all of our own logs and responses
+        self.mqtt.subscribe('%s/+/commands' % self.hardware_id)
+        ENV_HOT_RELOAD = env['ENV_HOT_RELOAD'] if 'ENV_HOT_RELOAD' in env.keys() else False
+        if ENV_HOT_RELOAD:
+            # Messages on `<id>/<service>/env` update that service's env
+            self.mqtt.subscribe('%s/+/env' % self.hardware_id)
+        for topic in _subscriptions:
+            self.mqtt.subscribe(topic)
+
+    def _get_updaters(self, http_client):
+        # Don't check again if we already checked recently (e.g. just before
+        # a reboot)
+        check_interval = env['UPDATE_CHECK_INTERVAL'] if 'UPDATE_CHECK_INTERVAL' in env.keys() else 0
 
         # Get a list of all services
         for service in os.listdir('services'):
             if service == '__init__.py' or service.startswith('.'):
                 continue
 
-            self._logger.info('Check for updates to %s' % service)
             service_env = get_env(service)
 
             if 'GITHUB_URL' in service_env.keys():
-                self._logger.info('GITHUB_URL=%s' % service_env['GITHUB_URL'])
+                self._logger.info('%s GITHUB_URL=%s' % (service, service_env['GITHUB_URL']))
                 remote_module_path = service_env['PYTHON_MODULE_PATH'] if 'PYTHON_MODULE_PATH' in service_env else ''
-                o = OTAUpdater(service_env['GITHUB_URL'], module_path='services/%s' % service,
-                               remote_module_path=remote_module_path)
+                # Optional release asset holding the whole service, e.g. `<service>.tar.gz`
+                bundle = service_env['RELEASE_BUNDLE'] if 'RELEASE_BUNDLE' in service_env else None
+                # Optional release asset with precompiled bytecode, e.g. `<service>-mpy%d.tar.gz`
+                mpy_bundle = service_env['MPY_BUNDLE'] if 'MPY_BUNDLE' in service_env else None
+                yield service, OTAUpdater(service_env['GITHUB_URL'], module_path='services/%s' % service,
+                                          remote_module_path=remote_module_path,
+                                          http_client=http_client,
+                                          bundle=bundle,
+                                          mpy_bundle=mpy_bundle,
+                                          check_interval=check_interval)
+            else:
+                self._logger.error('No env defined for %s' % service)
+
+    @requires_network
+    def _get_updates(self):
+        reboot_flag = False
+
+        # Share one client (and its keep-alive connections) between services.
+        # Release and listing lookups are cached on flash and revalidated with
+        # ETags, so unchanged lookups don't count against the rate limit.
+        http_client = HttpClient(cache=HttpCache())
+
+        for service, o in self._get_updaters(http_client):
+            if self._peer_updates == 'receive' and o.bundle:
+                continue
+            self._logger.info('Check for updates to %s' % service)
+            try:
+                _memory.maybe_collect()
+                if o.check_for_update_to_install_during_next_reboot():
+                    if self._peer_updates == 'seed' and o.bundle:
+                        self._seed_update(service, o)
+                    # Start the download with as much contiguous memory as possible
+                    _memory.collect()
+                    o.download_and_install_update_if_available()
+                    reboot_flag = True
+                _memory.maybe_collect()
+            except Exception as e:
+                self._logger.error("Couldn't get update info. %s" % repr(e))
+                sys.print_exception(e, self._log_stream)
+
+        http_client.close()
+
+        if reboot_flag:
+            self._logger.info('Updates installed. Rebooting...')
+            machine.reset()
+
+    async def _get_updates_async(self):
+        # Check all services for updates concurrently while they are already
+        # running, then download and install whatever was found and reboot
+        UPDATE_CHECK_CONCURRENCY = env['UPDATE_CHECK_CONCURRENCY'] if 'UPDATE_CHECK_CONCURRENCY' in env.keys() else 4
+        UPDATE_CHECK_DEADLINE = env['UPDATE_CHECK_DEADLINE'] if 'UPDATE_CHECK_DEADLINE' in env.keys() else 60
+
+        # Rather than skipping the check until the next reset, wait for the
+        # network manager to (re)connect
+        if not wifi.isconnected():
+            self._logger.info('Waiting for a network connection to check for updates.')
+            await _network.wait_connected()
+
+        http_client = HttpClient(cache=HttpCache())
+        async_client = AsyncHttpClient(cache=http_client.cache)
+        # Services with a bundle get their updates from a peer instead
+        updaters = [(service, o) for service, o in self._get_updaters(http_client)
+                    if not (self._peer_updates == 'receive' and o.bundle)]
+        pending = []
+
+        async def worker():
+            while updaters:
+                service, o = updaters.pop()
+                self._logger.info('Check for updates to %s' % service)
                 try:
-                    gc.collect()
-                    if o.check_for_update_to_install_during_next_reboot():
-                        gc.collect()
-                        o.download_and_install_update_if_available()
-                        reboot_flag = True
-                    gc.collect()                    
+                    if await o.check_for_update_async(async_client):
+                        pending.append((service, o))
                 except Exception as e:
                     self._logger.error("Couldn't get update info. %s" % repr(e))
                     sys.print_exception(e, self._log_stream)
+                _memory.maybe_collect()
+
+        workers = [worker() for i in range(min(UPDATE_CHECK_CONCURRENCY, len(updaters)))]
+        try:
+            await asyncio.wait_for(asyncio.gather(*workers), UPDATE_CHECK_DEADLINE)
+        except asyncio.TimeoutError:
+            self._logger.error('Update checks did not finish within %ss.' % UPDATE_CHECK_DEADLINE)
+
+        if self._peer_updates == 'seed':
+            for service, o in pending:
+                if o.bundle:
+                    self._seed_update(service, o)
+
+        await self._install_updates_async(pending)
+        http_client.close()
+
+    async def _install_updates_async(self, pending):
+        # 'immediate' installs updates and reboots right away; 'deferred'
+        # downloads them next to the running version at low priority and
+        # installs them in the maintenance window or on `apply_updates`
+        UPDATE_INSTALL = env['UPDATE_INSTALL'] if 'UPDATE_INSTALL' in env.keys() else 'immediate'
+        if UPDATE_INSTALL == 'deferred':
+            await self._download_updates_async(pending)
+            return
+
+        reboot_flag = False
+        # Installing blocks the event loop; don't let the watchdog reset the
+        # device halfway through
+        _scheduler.suspend()
+        try:
+            for service, o in pending:
+                try:
+                    o.download_and_install_update_if_available()
+                    reboot_flag = True
+                except Exception as e:
+                    self._logger.error("Couldn't install update to %s. %s" % (service, repr(e)))
+                    sys.print_exception(e, self._log_stream)
+                _memory.maybe_collect()
+        finally:
+            _scheduler.resume()
+
+        if reboot_flag:
+            self._logger.info('Updates installed. Rebooting...')
+            machine.reset()
+
+    async def _download_updates_async(self, pending):
+        # Pause between downloaded files so services keep running
+        UPDATE_DOWNLOAD_PAUSE_MS = env['UPDATE_DOWNLOAD_PAUSE_MS'] if 'UPDATE_DOWNLOAD_PAUSE_MS' in env.keys() else 100
+        # [start_hour, end_hour) in UTC, e.g. [2, 4]
+        UPDATE_WINDOW = env['UPDATE_WINDOW'] if 'UPDATE_WINDOW' in env.keys() else None
+
+        downloaded = False
+        for service, o in pending:
+            # A step (e.g. a whole bundle) can block the event loop for a
+            # while; don't let the watchdog reset the device meanwhile
+            _scheduler.suspend()
+            try:
+                await o.download_pending_update_async(UPDATE_DOWNLOAD_PAUSE_MS)
+                downloaded = True
+            except Exception as e:
+                self._logger.error("Couldn't download update to %s. %s" % (service, repr(e)))
+                sys.print_exception(e, self._log_stream)
+            finally:
+                _scheduler.resume()
+            _memory.maybe_collect()
+
+        if not downloaded:
+            return
+        if UPDATE_WINDOW is None:
+            self.apply_updates()
+            return
+
+        self._logger.info('Updates downloaded, installing between %02d:00 and %02d:00 UTC.' % tuple(UPDATE_WINDOW))
+        start, end = UPDATE_WINDOW
+        while True:
+            await asyncio.sleep(60)
+            # The time of day is unknown until NTP has synced
+            if not _startup_time:
+                continue
+            hour = time.localtime(time.time() + _startup_time)[3]
+            if (start <= hour < end) if start <= end else (hour >= start or hour < end):
+                self.apply_updates()
+                return
+
+    def _init_peer_updates(self):
+        # Let one device (or a gateway running the supervisor) of a fleet
+        # download updates and pass them on to the others over MQTT, so WAN
+        # traffic doesn't grow with the fleet. Only services with a
+        # RELEASE_BUNDLE take part:
+        # - 'seed' serves the bundle of every update it downloads, and the
+        #   last one of each service after a reset
+        # - 'receive' doesn't check GitHub for these services, but installs
+        #   the versions announced by the seeder (as set by UPDATE_INSTALL)
+        # Peers share the topics under `<PEER_TOPIC>/<service>/`.
+        PEER_UPDATES = env['PEER_UPDATES'] if 'PEER_UPDATES' in env.keys() else None
+        self._peer_topic = env['PEER_TOPIC'] if 'PEER_TOPIC' in env.keys() else 'updates'
+        # Chunk size in bytes and chunks sent per 100ms when seeding
+        self._peer_chunk_size = env['PEER_CHUNK_SIZE'] if 'PEER_CHUNK_SIZE' in env.keys() else 1024
+        self._peer_rate = env['PEER_RATE'] if 'PEER_RATE' in env.keys() else 10
+        # Ask for missing chunks again after PEER_TIMEOUT_MS without any,
+        # at most PEER_RETRIES times in a row
+        self._peer_timeout_ms = env['PEER_TIMEOUT_MS'] if 'PEER_TIMEOUT_MS' in env.keys() else 5000
+        self._peer_retries = env['PEER_RETRIES'] if 'PEER_RETRIES' in env.keys() else 5
+
+        self._peer_updates = None
+        if PEER_UPDATES is None:
+            return
+        if PEER_UPDATES not in ('seed', 'receive'):
+            self._logger.error('Unsupported PEER_UPDATES: %s' % PEER_UPDATES)
+            return
+        self._peer_updates = PEER_UPDATES
+
+        try:
+            os.mkdir(_PEER_DIRECTORY)
+        except OSError:
+            pass
+
+        if PEER_UPDATES == 'seed':
+            manifests = {}
+            for name in os.listdir(_PEER_DIRECTORY):
+                if name.endswith('.json'):
+                    with open('%s/%s' % (_PEER_DIRECTORY, name)) as f:
+                        manifests[name[:-5]] = json.load(f)
+            for name in os.listdir(_PEER_DIRECTORY):
+                # Bundles of versions that were replaced since
+                if not name.endswith('.json') and name not in [m['file'] for m in manifests.values()]:
+                    os.remove('%s/%s' % (_PEER_DIRECTORY, name))
+            for service, manifest in manifests.items():
+                self._seed(service, manifest)
+            return
+
+        # Bundles fetched before the last reset are unpacked by now
+        for name in os.listdir(_PEER_DIRECTORY):
+            os.remove('%s/%s' % (_PEER_DIRECTORY, name))
+        for service, o in self._get_updaters(None):
+            if o.bundle:
+                subscribe('%s/%s/manifest' % (self._peer_topic, service), self._on_peer_manifest(service))
+
+    def _seed(self, service, manifest):
+        topic = '%s/%s' % (self._peer_topic, service)
+        seeder = PeerSeeder(self.mqtt, topic, '%s/%s' % (_PEER_DIRECTORY, manifest['file']),
+                            manifest, self._peer_rate)
+        if service in self._seeders:
+            self._seeders[service][1].cancel()
+        subscribe(topic + '/requests', seeder.on_request)
+        self._seeders[service] = (seeder, self._asyncio_loop.create_task(seeder.serve()))
+        self._logger.info('Seeding %s %s' % (service, manifest['version']))
+
+    def _seed_update(self, service, o):
+        # Download the bundle of the update staged in `o` for peers and
+        # install the update from it rather than downloading it again
+        version = o.get_version(o.update_path, '.version_on_reboot')
+        name = '%s-%s' % (service, version)
+        path = '%s/%s' % (_PEER_DIRECTORY, name)
+        _scheduler.suspend()
+        try:
+            if not o.download_bundle_file(version, path):
+                return
+            manifest = make_manifest(path, version, self._peer_chunk_size)
+            manifest['file'] = name
+            with open('%s/%s.json' % (_PEER_DIRECTORY, service), 'w') as f:
+                json.dump(manifest, f)
+            o.bundle_file = path
+            self._seed(service, manifest)
+        except Exception as e:
+            self._logger.error("Couldn't download %s for peers. %s" % (service, repr(e)))
+            sys.print_exception(e, self._log_stream)
+        finally:
+            _scheduler.resume()
+
+    def _on_peer_manifest(self, service):
+        def on_manifest(topic, message):
+            if service in self._receivers or not message:
+                return
+            manifest = json.loads(message)
+            self._receivers[service] = None
+            self._asyncio_loop.create_task(self._receive_update(service, manifest))
+        return on_manifest
+
+    async def _receive_update(self, service, manifest):
+        topic = '%s/%s' % (self._peer_topic, service)
+        try:
+            for name, o in self._get_updaters(None):
+                if name == service:
+                    break
             else:
-                self._logger.error('No env defined for %s' % self.name)
+                return
+            if not o.check_for_update_from(manifest['version']):
+                return
+
+            self._logger.info('Fetching %s %s from peers' % (service, manifest['version']))
+            path = '%s/%s' % (_PEER_DIRECTORY, service)
+            receiver = PeerReceiver(self.mqtt, topic, path, manifest, self.hardware_id,
+                                    self._peer_timeout_ms, self._peer_retries)
+            self._receivers[service] = receiver
+            subscribe(topic + '/chunks', receiver.on_chunk)
+            try:
+                received = await receiver.fetch()
+            finally:
+                # Stays subscribed; chunks are ignored until the next update
+                _topic_handlers.pop((topic + '/chunks').encode(), None)
+            if not received:
+                self._logger.error("Couldn't fetch %s %s from peers." % (service, manifest['version']))
+                return
+
+            o.bundle_file = path
+            await self._install_updates_async([(service, o)])
+        except Exception as e:
+            self._logger.error("Couldn't update %s from peers. %s" % (service, repr(e)))
+            sys.print_exception(e, self._log_stream)
+        finally:
+            del self._receivers[service]
+
+    def _apply_pending_updates(self):
+        applied = False
+        for service, o in self._get_updaters(None):
+            try:
+                if o.apply_pending_updates_if_available():
+                    applied = True
+            except Exception as e:
+                self._logger.error("Couldn't apply update to %s. %s" % (service, repr(e)))
                 sys.print_exception(e, self._log_stream)
+        return applied
 
-        if reboot_flag:
+    def apply_updates(self):
+        # Install downloaded updates and reboot into them
+        _scheduler.suspend()
+        try:
+            applied = self._apply_pending_updates()
+        finally:
+            _scheduler.resume()
+        if applied:
             self._logger.info('Updates installed. Rebooting...')
             machine.reset()
+        return False
 
     def _init_services(self):
         self._logger.info('root environment = %s' % (json.dumps(self.get_env())))
@@ -388,26 +1137,142 @@ class Service(BaseService):
                 if service == 'supervisor':
                     self._services[service] = self
                 else:
-                    # Create new service
-                    exec('import %s' % service, locals())
-                    self._services[service] = locals()[service].Service()
+                    with self._boot.phase('import %s' % service):
+                        # Import precompiled bytecode if it matches this firmware
+                        check_bytecode('services/%s' % service)
+
+                        # Create new service
+                        exec('import %s' % service, locals())
+                        self._services[service] = locals()[service].Service()
                 self._logger.info('Initialized %s %s' % (self._services[service].name,
                                              self._services[service].version))
+                self._route_commands(service)
                 service_env = self.get_env(service)
                 self._logger.info('%s environment = %s' % (service, json.dumps(service_env)))
             except Exception as e:
                 self._logger.error('Failed to initialize %s: %s' % (service, repr(e)))
                 sys.print_exception(e, self._log_stream)
 
+    def _start_asyncio_loop(self):
         self._logger.info('Start asyncio background thread.')
 
         # Start the asyncio loop in a background thread
         _thread.start_new_thread(self._asyncio_loop.run_forever, tuple())
 
+    def _publish_boot_timeline(self):
+        timeline = self._boot.as_dict()
+        self._logger.info('Boot took %dms (%dms after reset)' %
+                          (timeline['total_us'] // 1000,
+                           timeline['started_ms'] + timeline['total_us'] // 1000))
+        try:
+            # Retained, so it can be read whenever a client connects
+            self.mqtt.publish('%s/supervisor/boot' % self.hardware_id,
+                              json.dumps(timeline), retain=True)
+        except Exception as e:
+            self._logger.error("Couldn't publish boot timeline. %s" % repr(e))
+            sys.print_exception(e, self._log_stream)
+
+    def boot_timeline(self):
+        return self._boot.as_dict()
+
+    def _route_commands(self, service):
+        def enqueue(topic, message):
+            try:
+                message = json.loads(message)
+            except ValueError:
+                self._logger.error('Ignoring command for %s that is not JSON.' % service)
+                return
+            if not _command_queue.put((service, message, time.ticks_ms())):
+                _metrics.dropped_commands += 1
+                self._logger.error('Command queue full, dropping command for %s.' % service)
+        _topic_handlers[('%s/%s/commands' % (self.hardware_id, service)).encode()] = enqueue
+
+        def reload_env(topic, message):
+            self._logger.info('Updating %s environment.' % service)
+            self.update_env(json.loads(message), service)
+        _topic_handlers[('%s/%s/env' % (self.hardware_id, service)).encode()] = reload_env
+        _env_listeners[service] = self._services[service]
+
     @property
     def status(self):
         return {name: (service.state, service.version) for name, service in self._services.items()}
 
+    def _init_scheduler(self):
+        # Longest a service should run without yielding, and whether to
+        # 'warn' or also 'throttle' it when it runs longer
+        SERVICE_SLICE_MS = env['SERVICE_SLICE_MS'] if 'SERVICE_SLICE_MS' in env.keys() else 100
+        SERVICE_OVERRUN = env['SERVICE_OVERRUN'] if 'SERVICE_OVERRUN' in env.keys() else 'warn'
+        # A service that doesn't yield for this long is restarted once it does
+        SERVICE_HANG_MS = env['SERVICE_HANG_MS'] if 'SERVICE_HANG_MS' in env.keys() else 10000
+        # Reset the device if the event loop is blocked for this many seconds
+        # (0 leaves the hardware watchdog off; once on, it can't be stopped)
+        WDT_TIMEOUT = env['WDT_TIMEOUT'] if 'WDT_TIMEOUT' in env.keys() else 0
+        _scheduler.configure(SERVICE_SLICE_MS, SERVICE_OVERRUN, SERVICE_HANG_MS)
+        _scheduler.start(WDT_TIMEOUT)
+
+    def _init_metrics(self):
+        # Publish the metrics (retained) every METRICS_INTERVAL seconds; 0
+        # turns publishing off (the `metrics` command still works)
+        METRICS_INTERVAL = env['METRICS_INTERVAL'] if 'METRICS_INTERVAL' in env.keys() else 60
+        # How often to measure event loop lag
+        METRICS_LAG_INTERVAL_MS = env['METRICS_LAG_INTERVAL_MS'] if 'METRICS_LAG_INTERVAL_MS' in env.keys() else 100
+        self._asyncio_loop.create_task(_metrics.measure_loop_lag(METRICS_LAG_INTERVAL_MS))
+        if METRICS_INTERVAL:
+            self._asyncio_loop.create_task(self._publish_metrics(METRICS_INTERVAL))
+
+    async def _publish_metrics(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            # Skip this round while the broker is unreachable rather than
+            # blocking the event loop until it's back
+            try:
+                self.mqtt.publish_once('%s/supervisor/metrics' % self.hardware_id,
+                                       json.dumps(self._collect_metrics(False)), retain=True)
+            except Exception as e:
+                self._logger.error("Couldn't publish metrics. %s" % repr(e))
+
+    def metrics(self):
+        # Histograms are cumulative since boot, with buckets bounded by
+        # `bounds_ms`
+        return self._collect_metrics(True)
+
+    def _collect_metrics(self, probe_heap):
+        # Probing for the largest free block allocates (and collects), so it
+        # is left out of the periodic metrics
+        log_stream = self._log_stream
+        return {'bounds_ms': BOUNDS_MS,
+                'loop_lag_ms': _metrics.loop_lag.as_dict(),
+                'services': {name: stats.as_dict() for name, stats in _metrics.services.items()},
+                'mqtt': {'published': _metrics.published,
+                         'published_bytes': _metrics.published_bytes},
+                'commands': {'latency_ms': _metrics.command_latency.as_dict(),
+                             'dropped': _metrics.dropped_commands},
+                'logs': {'dropped_lines': log_stream.dropped_lines,
+                         'spool_dropped_segments': (log_stream._spool.dropped_segments
+                                                    if log_stream._spool else 0)},
+                'scheduler': _scheduler.stats(),
+                'peer': {'seeding': {service: seeder.stats() for service, (seeder, task) in self._seeders.items()},
+                         'receiving': {service: {'version': receiver.manifest['version'],
+                                                 'received_chunks': receiver.received,
+                                                 'chunks': receiver.manifest['chunks'],
+                                                 'requests': receiver.requests}
+                                       for service, receiver in self._receivers.items() if receiver}},
+                'heap': {'free': gc.mem_free(),
+                         'largest_free_block': largest_free_block() if probe_heap else None,
+                         'collections': _memory.collections,
+                         'max_gc_pause_us': _memory.max_pause_us}}
+
+    def log_stats(self):
+        return {'buffered_bytes': len(self._log_stream._ring),
+                'buffered_lines': self._log_stream._ring.lines,
+                'dropped_lines': self._log_stream.dropped_lines,
+                'spool_pending': self._log_stream._replaying,
+                'spool_dropped_segments': (self._log_stream._spool.dropped_segments
+                                           if self._log_stream._spool else 0)}
+
+    def gc_stats(self):
+        return _memory.stats()
+
     def reset(self):
         machine.reset()
 
@@ -423,15 +1288,15 @@ class Service(BaseService):
     async def loop(self):
         self._logger.debug('state=%s' % self.state)
 
-        # Keep wifi and mqtt connections alive
+        # Keep the mqtt connection alive (the network manager takes care of
+        # wifi)
         try:
             self.mqtt.ping()
         except:
-            # _mqtt_connect() requires wifi, so this will also reconnect wifi
-            # if necessary
-            self._mqtt_connect()
+            # Waits for wifi without blocking other services
+            await self._mqtt_connect_async()
 
-        gc.collect()
+        _memory.maybe_collect()
         self._logger.info('gc.mem_free()=%s' % gc.mem_free())
 
         await asyncio.sleep(60)
@@ -0,0 +1,35 @@
+class SPSCQueue:
+    # Fixed-capacity queue for handing items from one producer thread to one
+    # consumer thread. Storage is preallocated, so `put`/`get` don't allocate.
+    # Only the producer moves `_head` and only the consumer moves `_tail`, and
+    # each index is published with a single assignment after the slot has
+    # been written/cleared, so no lock is needed with one thread on each side.
+
+    def __init__(self, capacity):
+        # One slot is kept free to tell a full queue from an empty one
+        self._items = [None] * (capacity + 1)
+        self._head = 0
+        self._tail = 0
+
+    def __len__(self):
+        return (self._head - self._tail) % len(self._items)
+
+    def put(self, item):
+        # Returns False (and drops `item`) if the queue is full
+        head = self._head
+        next_head = (head + 1) % len(self._items)
+        if next_head == self._tail:
+            return False
+        self._items[head] = item
+        self._head = next_head
+        return True
+
+    def get(self, default=None):
+        tail = self._tail
+        if tail == self._head:
+            return default
+        item = self._items[tail]
+        self._items[tail] = None
+        self._tail = (tail + 1) % len(self._items)
+        return item
+
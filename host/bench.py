@@ -0,0 +1,338 @@
+# Benchmarks for the supervisor's hot paths, run on a host with the
+# stand-ins from `emulator`:
+#
+#     python host/bench.py                 # everything
+#     python host/bench.py boot ota        # selected benchmarks
+#     python host/bench.py --output bench_output.txt
+#
+# Each case runs in a fresh interpreter (the supervisor keeps module-level
+# state and background threads), once for timing and once more under
+# tracemalloc for the peak allocation, which slows things down too much to
+# time at the same time. The peak covers the measured section of the whole
+# process, i.e. including the broker and GitHub stubs.
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import emulator
+
+ENV = {'WIFI_SSID': 'bench', 'WIFI_PASSWORD': 'bench', 'MQTT_HOST': 'mqtt.local',
+       'LOG_LOCALLY': False, 'LOG_LEVEL': 'WARNING'}
+
+ECHO_SERVICE = '''
+from supervisor import BaseService
+
+
+class Service(BaseService):
+    def echo(self, value):
+        return value
+'''
+
+
+# Allocated memory when the measured section started
+_baseline = 0
+
+
+def _start():
+    # Call right before the measured section
+    global _baseline
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+        _baseline = tracemalloc.get_traced_memory()[0]
+    return time.perf_counter()
+
+
+def _boot_device(services=None, service_envs=None, env=None):
+    device_env = dict(ENV)
+    device_env.update(env or {})
+    device = emulator.Device(device_env, services, service_envs)
+    supervisor = device.import_supervisor()
+    return device, supervisor
+
+
+def bench_mqtt_stream(lines=5000, line_size=80, batch_bytes=1024):
+    # Log lines written to an `MQTTStream` until the broker has received all
+    # of them
+    import _thread
+    import uasyncio as asyncio
+    from umqtt.robust import MQTTClient
+
+    broker = emulator.serve_broker()
+    device, supervisor = _boot_device()
+    client = MQTTClient('bench', 'mqtt.local')
+    client.connect()
+    stream = supervisor.MQTTStream(client, 'bench', print_output=False, buffer_size=8192,
+                                   overflow='block', batch_bytes=batch_bytes, batch_ms=20)
+
+    received = [0]
+    done = threading.Event()
+
+    def on_log(topic, payload):
+        records = json.loads(payload)
+        received[0] += len(records) if isinstance(records, list) else 1
+        if received[0] >= lines:
+            done.set()
+    broker.subscribe('bench/+/logging', on_log)
+
+    loop = asyncio.get_event_loop()
+    loop.create_task(stream._process_log_queue())
+    _thread.start_new_thread(loop.run_forever, ())
+    while stream._ring.consumer is None:
+        time.sleep(0.001)
+
+    line = 'INFO:bench:' + 'x' * (line_size - 12) + '\n'
+    start = _start()
+    for i in range(lines):
+        stream.write(line)
+    done.wait(60)
+    elapsed = time.perf_counter() - start
+    return {'lines': received[0],
+            'seconds': elapsed,
+            'lines_per_s': received[0] / elapsed,
+            'kib_per_s': received[0] * line_size / elapsed / 1024,
+            'messages': client.published,
+            'dropped_lines': stream.dropped_lines}
+
+
+def bench_command_rtt(commands=200):
+    # Round trip of remote commands: broker -> `_mqtt_callback` -> command
+    # queue -> `_process_mqtt_messages` -> response on the broker
+    broker = emulator.serve_broker()
+    device, supervisor = _boot_device({'bench': ECHO_SERVICE}, {'bench': {}})
+    service = supervisor.Service()
+    prefix = '%s/bench/' % service.hardware_id
+
+    response = threading.Event()
+    broker.subscribe(prefix + 'responses', lambda topic, payload: response.set())
+
+    # Wait for the subscriptions to be in place
+    response.clear()
+    while not response.is_set():
+        broker.publish(prefix + 'commands', json.dumps({'command': 'echo', 'args': [0], 'token': 'warmup'}))
+        response.wait(0.1)
+
+    latencies = []
+    _start()
+    for i in range(commands):
+        response.clear()
+        start = time.perf_counter()
+        broker.publish(prefix + 'commands', json.dumps({'command': 'echo', 'args': [i], 'token': str(i)}))
+        if not response.wait(5):
+            break
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    return {'commands': len(latencies),
+            'p50_ms': statistics.median(latencies),
+            'p95_ms': latencies[int(len(latencies) * 0.95) - 1],
+            'max_ms': latencies[-1],
+            'commands_per_s': len(latencies) / (sum(latencies) / 1000)}
+
+
+def _release_files(files, file_size, version):
+    return {'app/file%03d.py' % i: (b'# %s %d\n' % (version.encode(), i)).ljust(file_size, b'#')
+            for i in range(files)}
+
+
+def bench_ota(files=16, file_size=2048, mode='tree'):
+    # Time to check for and install a release of `files` files. `mode` is
+    # 'tree' (files downloaded one by one), 'delta' (only one file changed
+    # since the installed release) or 'bundle' (a .tar.gz release asset).
+    github = emulator.serve_github()
+    device, supervisor = _boot_device()
+    import usocket
+    from supervisor.ota_updater import OTAUpdater, HttpClient, HttpCache
+    from github import make_bundle
+
+    device.add_service('app', '', 'v0.0.0')
+
+    def updater():
+        return OTAUpdater('https://github.com/bench/app', 'services/app', remote_module_path='app',
+                          http_client=HttpClient(cache=HttpCache()),
+                          bundle='app.tar.gz' if mode == 'bundle' else None)
+
+    v1 = _release_files(files, file_size, 'v1.0.0')
+    if mode == 'delta':
+        github.add_release('bench', 'app', 'v1.0.0', v1)
+        o = updater()
+        o.check_for_update_to_install_during_next_reboot()
+        o.download_and_install_update_if_available()
+        v2 = dict(v1)
+        v2['app/file000.py'] = v2['app/file000.py'].replace(b'#', b'!')
+        github.add_release('bench', 'app', 'v1.0.1', v2)
+    elif mode == 'bundle':
+        github.add_release('bench', 'app', 'v1.0.0', v1, {'app.tar.gz': make_bundle(v1)})
+    else:
+        github.add_release('bench', 'app', 'v1.0.0', v1)
+
+    o = updater()
+    requests = github.requests
+    connections = usocket.connections
+    start = _start()
+    o.check_for_update_to_install_during_next_reboot()
+    o.download_and_install_update_if_available()
+    elapsed = time.perf_counter() - start
+    o.http_client.close()
+    return {'seconds': elapsed,
+            'requests': github.requests - requests,
+            'connections': usocket.connections - connections,
+            'version': o.get_version('services/app')}
+
+
+def bench_peer(receivers=8, files=16, file_size=2048):
+    # A release bundle downloaded once by a seeder and fetched by
+    # `receivers` devices over MQTT, each with its own connection
+    import _thread
+    import uasyncio as asyncio
+    from umqtt.simple import MQTTClient
+    broker = emulator.serve_broker()
+    github = emulator.serve_github()
+    device, supervisor = _boot_device()
+    from supervisor.ota_updater import OTAUpdater
+    from supervisor.peer import PeerSeeder, PeerReceiver, make_manifest
+    from github import make_bundle
+
+    # Random contents, so the bundle doesn't compress away
+    v1 = {'app/file%03d.py' % i: os.urandom(file_size // 2).hex().encode() for i in range(files)}
+    github.add_release('bench', 'app', 'v1.0.0', v1, {'app.tar.gz': make_bundle(v1)})
+
+    def client(client_id, topic, callback):
+        c = MQTTClient(client_id, 'mqtt.local')
+        c.set_callback(callback)
+        c.connect()
+        c.subscribe(topic)
+
+        def pump():
+            while True:
+                c.wait_msg()
+        _thread.start_new_thread(pump, ())
+        return c
+
+    loop = asyncio.get_event_loop()
+    _thread.start_new_thread(loop.run_forever, ())
+    start = _start()
+    o = OTAUpdater('https://github.com/bench/app', 'services/app', bundle='app.tar.gz')
+    o.download_bundle_file('v1.0.0', 'seed.tar.gz')
+    manifest = make_manifest('seed.tar.gz', 'v1.0.0')
+    seeder = PeerSeeder(None, 'updates/app', 'seed.tar.gz', manifest, rate=50)
+    seeder.mqtt = client('seeder', 'updates/app/requests', seeder.on_request)
+    loop.create_task(seeder.serve())
+
+    done = []
+    fetches = []
+    for i in range(receivers):
+        receiver = PeerReceiver(None, 'updates/app', 'peer%d.tar.gz' % i, manifest, 'peer%d' % i)
+        receiver.mqtt = client('peer%d' % i, 'updates/app/chunks', receiver.on_chunk)
+        fetches.append(receiver)
+
+        async def fetch(receiver=receiver):
+            done.append(await receiver.fetch())
+        loop.create_task(fetch())
+    while len(done) < receivers:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    return {'seconds': elapsed,
+            'fetched': done.count(True),
+            'github_requests': github.requests,
+            'bundle_kib': manifest['size'] / 1024,
+            'chunks': manifest['chunks'],
+            'sent_chunks': seeder.sent_chunks,
+            'requests': sum(r.requests for r in fetches)}
+
+
+def bench_boot(services=8):
+    # `Service.__init__` with `services` trivial services installed
+    emulator.serve_broker()
+    sources = {'service%02d' % i: ECHO_SERVICE for i in range(services)}
+    device, supervisor = _boot_device(sources, {name: {} for name in sources})
+    start = _start()
+    service = supervisor.Service()
+    elapsed = time.perf_counter() - start
+    phases = sorted(service.boot_timeline()['phases'], key=lambda p: -p['us'])
+    return {'seconds': elapsed,
+            'slowest_phase': phases[0]['name'],
+            'slowest_phase_ms': phases[0]['us'] / 1000}
+
+
+BENCHMARKS = {
+    'mqtt_stream': (bench_mqtt_stream, [{'batch_bytes': 0}, {'batch_bytes': 1024}]),
+    'command_rtt': (bench_command_rtt, [{}]),
+    'ota': (bench_ota, [{'files': n, 'mode': mode}
+                        for n in (4, 16, 64) for mode in ('tree', 'delta', 'bundle')]),
+    'peer': (bench_peer, [{'receivers': n} for n in (1, 8, 32)]),
+    'boot': (bench_boot, [{'services': 1}, {'services': 8}, {'services': 32}]),
+}
+
+
+def _worker(name, params, trace):
+    emulator.install()
+    if trace:
+        tracemalloc.start()
+    result = BENCHMARKS[name][0](**params)
+    if trace:
+        result = {'peak_kib': (tracemalloc.get_traced_memory()[1] - _baseline) / 1024}
+    sys.stdout.write('RESULT %s\n' % json.dumps(result))
+    sys.stdout.flush()
+    # Skip waiting for the supervisor's threads
+    os._exit(0)
+
+
+def _run(name, params, trace=False):
+    # The worker's devices are created in (and removed with) a temporary
+    # directory, even if it is still writing to them when it exits
+    with tempfile.TemporaryDirectory() as tmp:
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', name,
+                              json.dumps(params)] + (['--trace'] if trace else []),
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=300,
+                             env=dict(os.environ, TMPDIR=tmp))
+    for line in out.stdout.decode().splitlines():
+        if line.startswith('RESULT '):
+            return json.loads(line[7:])
+    raise RuntimeError('%s %s failed' % (name, params))
+
+
+def _format(value):
+    return '%.3f' % value if isinstance(value, float) else str(value)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmarks', nargs='*', help=', '.join(BENCHMARKS))
+    parser.add_argument('--output', help='also write the results to this file')
+    parser.add_argument('--worker', nargs=2, help=argparse.SUPPRESS)
+    parser.add_argument('--trace', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        _worker(args.worker[0], json.loads(args.worker[1]), args.trace)
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: %s' % name)
+
+    lines = []
+    for name in args.benchmarks or BENCHMARKS:
+        for params in BENCHMARKS[name][1]:
+            try:
+                result = _run(name, params)
+                result.update(_run(name, params, trace=True))
+            except (RuntimeError, subprocess.TimeoutExpired) as e:
+                result = {'error': str(e)}
+            line = '%-12s %-28s %s' % (name, ' '.join('%s=%s' % kv for kv in params.items()),
+                                       ' '.join('%s=%s' % (k, _format(v)) for k, v in result.items()))
+            print(line)
+            lines.append(line)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+if __name__ == '__main__':
+    main()
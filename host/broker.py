@@ -0,0 +1,190 @@
+# Minimal MQTT 3.1.1 broker for running the supervisor on a host.
+#
+# Supports CONNECT, SUBSCRIBE (with `+` and `#` wildcards), PUBLISH with QoS
+# 0/1, retained messages and PINGREQ. The harness itself can publish and
+# listen in-process with `publish()` and `subscribe()`.
+
+import socketserver
+import struct
+import threading
+
+
+def topic_matches(pattern, topic):
+    pattern = pattern.split('/')
+    topic = topic.split('/')
+    for i, part in enumerate(pattern):
+        if part == '#':
+            return True
+        if i >= len(topic) or (part != '+' and part != topic[i]):
+            return False
+    return len(pattern) == len(topic)
+
+
+def _packet(header, body):
+    length = bytearray()
+    n = len(body)
+    while True:
+        byte = n & 0x7f
+        n >>= 7
+        length.append(byte | 0x80 if n else byte)
+        if not n:
+            break
+    return bytes((header,)) + bytes(length) + body
+
+
+def _publish_packet(topic, payload, retain=False):
+    topic = topic.encode()
+    return _packet(0x30 | retain, struct.pack('!H', len(topic)) + topic + payload)
+
+
+class _Session(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.subscriptions = []
+        self.client_id = None
+        self.send_lock = threading.Lock()
+        self._file = self.request.makefile('rb')
+
+    def send(self, data):
+        with self.send_lock:
+            self.request.sendall(data)
+
+    def _read(self, n):
+        data = self._file.read(n)
+        if len(data) < n:
+            raise EOFError
+        return data
+
+    def _read_str(self, body, offset):
+        n = struct.unpack_from('!H', body, offset)[0]
+        return body[offset + 2:offset + 2 + n].decode(), offset + 2 + n
+
+    def handle(self):
+        broker = self.server.broker
+        try:
+            while True:
+                header = self._read(1)[0]
+                n = 0
+                shift = 0
+                while True:
+                    b = self._read(1)[0]
+                    n |= (b & 0x7f) << shift
+                    if not b & 0x80:
+                        break
+                    shift += 7
+                body = self._read(n)
+                op = header & 0xf0
+
+                if op == 0x10:  # CONNECT
+                    offset = self._read_str(body, 0)[1] + 4
+                    self.client_id = self._read_str(body, offset)[0]
+                    broker._connected(self)
+                    self.send(b'\x20\x02\x00\x00')
+                elif op == 0x30:  # PUBLISH
+                    topic, offset = self._read_str(body, 0)
+                    qos = (header >> 1) & 3
+                    if qos:
+                        pid = body[offset:offset + 2]
+                        offset += 2
+                    broker.publish(topic, body[offset:], retain=header & 1)
+                    if qos == 1:
+                        self.send(b'\x40\x02' + pid)
+                elif op == 0x80:  # SUBSCRIBE
+                    pid = body[:2]
+                    offset = 2
+                    granted = bytearray()
+                    while offset < len(body):
+                        topic, offset = self._read_str(body, offset)
+                        offset += 1
+                        self.subscriptions.append(topic)
+                        granted.append(0)
+                    self.send(_packet(0x90, pid + granted))
+                    for topic, payload in list(broker.retained.items()):
+                        if any(topic_matches(p, topic) for p in self.subscriptions):
+                            self.send(_publish_packet(topic, payload, retain=True))
+                elif op == 0xc0:  # PINGREQ
+                    self.send(b'\xd0\x00')
+                elif op == 0xe0:  # DISCONNECT
+                    break
+        except (EOFError, OSError):
+            pass
+        finally:
+            broker._disconnected(self)
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Broker:
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self._server = _Server((host, port), _Session)
+        self._server.broker = self
+        self.address = self._server.server_address
+        self.retained = {}
+        self._sessions = []
+        self._listeners = []
+        self._lock = threading.Lock()
+        # Counters of messages routed through the broker
+        self.messages = 0
+        self.bytes = 0
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _connected(self, session):
+        with self._lock:
+            self._sessions.append(session)
+
+    def _disconnected(self, session):
+        with self._lock:
+            if session in self._sessions:
+                self._sessions.remove(session)
+
+    def clients(self):
+        with self._lock:
+            return [session.client_id for session in self._sessions]
+
+    def subscribe(self, pattern, callback):
+        # Call `callback(topic, payload)` from the broker's threads for every
+        # message published to a topic matching `pattern`
+        with self._lock:
+            self._listeners.append((pattern, callback))
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._listeners = [(p, c) for p, c in self._listeners if c is not callback]
+
+    def publish(self, topic, payload, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        with self._lock:
+            self.messages += 1
+            self.bytes += len(payload)
+            if retain:
+                if payload:
+                    self.retained[topic] = payload
+                else:
+                    self.retained.pop(topic, None)
+            sessions = list(self._sessions)
+            listeners = list(self._listeners)
+
+        packet = None
+        for session in sessions:
+            if any(topic_matches(p, topic) for p in session.subscriptions):
+                if packet is None:
+                    packet = _publish_packet(topic, payload)
+                try:
+                    session.send(packet)
+                except OSError:
+                    pass
+        for pattern, callback in listeners:
+            if topic_matches(pattern, topic):
+                callback(topic, payload)
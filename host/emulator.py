@@ -0,0 +1,154 @@
+# Runs the supervisor on a host under CPython.
+#
+#     import emulator
+#     emulator.install()
+#     device = emulator.Device(env={...}, services={'blink': SOURCE})
+#     supervisor = device.import_supervisor()
+#     service = supervisor.Service()
+#
+# `install()` puts the stand-ins in `stubs/` (machine, network, ntptime,
+# umqtt, uasyncio, u* modules) on `sys.path` and adds the MicroPython-only
+# functions the supervisor uses (`time.ticks_ms`, `sys.print_exception`,
+# `gc.mem_free`, ...) to CPython's modules. `Device` lays out a device's
+# filesystem (envs/, services/) in a temporary directory and makes it the
+# working directory.
+
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import traceback
+import types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STUBS = os.path.join(HERE, 'stubs')
+# The supervisor package is the repository itself
+PACKAGE = os.path.dirname(HERE)
+
+# Heap size reported by `gc.mem_free() + gc.mem_alloc()`, roughly that of an
+# ESP32 with SPIRAM
+HEAP_SIZE = 4 * 1024 * 1024
+
+_installed = False
+
+
+def _mem_alloc():
+    # Allocations traced by tracemalloc (0 unless it is running)
+    return tracemalloc.get_traced_memory()[0]
+
+
+def install(heap_size=HEAP_SIZE):
+    global _installed, HEAP_SIZE
+    HEAP_SIZE = heap_size
+    if _installed:
+        return
+    _installed = True
+    sys.path.insert(0, STUBS)
+
+    monotonic = time.monotonic
+    wall = time.time
+    time.ticks_ms = lambda: int(monotonic() * 1000)
+    time.ticks_us = lambda: int(monotonic() * 1000000)
+    time.ticks_diff = lambda new, old: new - old
+    time.ticks_add = lambda ticks, delta: ticks + delta
+    time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+    time.sleep_us = lambda us: time.sleep(us / 1000000)
+    # MicroPython's `time.time()` returns whole seconds
+    time.time = lambda: int(wall())
+
+    def print_exception(e, file=sys.stdout):
+        traceback.print_exception(type(e), e, e.__traceback__, file=file)
+    sys.print_exception = print_exception
+
+    def ilistdir(path='.'):
+        for entry in os.scandir(path):
+            yield entry.name, 0x4000 if entry.is_dir() else 0x8000, 0
+    os.ilistdir = ilistdir
+
+    gc.mem_alloc = _mem_alloc
+    gc.mem_free = lambda: HEAP_SIZE - _mem_alloc()
+    gc.threshold = _threshold
+
+
+_gc_threshold = -1
+
+
+def _threshold(amount=None):
+    # Recorded only; CPython's own collector keeps running as usual
+    global _gc_threshold
+    if amount is None:
+        return _gc_threshold
+    _gc_threshold = amount
+
+
+class Device:
+    # A device's filesystem in a temporary directory: `envs/env.json`,
+    # `envs/<service>/env.json` and `services/<service>/`, with the supervisor
+    # linked to this repository
+
+    def __init__(self, env, services=None, service_envs=None, root=None):
+        self.root = root or tempfile.mkdtemp(prefix='supervisor-')
+        os.makedirs(os.path.join(self.root, 'envs'), exist_ok=True)
+        os.makedirs(os.path.join(self.root, 'services'), exist_ok=True)
+        self.write_env(env)
+        os.symlink(PACKAGE, os.path.join(self.root, 'services', 'supervisor'))
+        for name, source in (services or {}).items():
+            self.add_service(name, source)
+        for name, service_env in (service_envs or {}).items():
+            self.write_env(service_env, name)
+        os.chdir(self.root)
+
+    def write_env(self, env, service=None):
+        if service:
+            os.makedirs(os.path.join(self.root, 'envs', service), exist_ok=True)
+            path = os.path.join(self.root, 'envs', service, 'env.json')
+        else:
+            path = os.path.join(self.root, 'envs', 'env.json')
+        with open(path, 'w') as f:
+            json.dump(env, f)
+
+    def add_service(self, name, source, version=None):
+        directory = os.path.join(self.root, 'services', name)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, '__init__.py'), 'w') as f:
+            f.write(source)
+        if version is not None:
+            with open(os.path.join(directory, '.version'), 'w') as f:
+                f.write(version)
+
+    def import_supervisor(self):
+        services = os.path.join(self.root, 'services')
+        if services not in sys.path:
+            sys.path.insert(0, services)
+        import supervisor
+        # `_readable` is a generator yielding to the uasyncio poller, which
+        # MicroPython can await directly; CPython needs it marked as a
+        # coroutine
+        supervisor._readable = types.coroutine(supervisor._readable)
+        return supervisor
+
+    def remove(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def serve_broker():
+    # Start an MQTT broker and point the `MQTT_HOST` of every device at it
+    import broker
+    import usocket
+    server = broker.Broker().start()
+    usocket.HOSTS['mqtt.local'] = server.address
+    return server
+
+
+def serve_github():
+    # Start a GitHub stub and route GitHub's host names to it
+    import github
+    import usocket
+    server = github.GitHubStub().start()
+    for host in (github.API_HOST, github.RAW_HOST, github.WEB_HOST):
+        usocket.HOSTS[host] = server.address
+    return server
@@ -0,0 +1,197 @@
+# Local HTTP server mimicking the parts of GitHub used by `OTAUpdater`:
+#
+#   api.github.com/repos/<owner>/<repo>/releases/latest
+#   api.github.com/repos/<owner>/<repo>/releases/tags/<tag>
+#   api.github.com/repos/<owner>/<repo>/git/trees/<tag>?recursive=1
+#   api.github.com/repos/<owner>/<repo>/contents/<path>?ref=refs/tags/<tag>
+#   raw.githubusercontent.com/<owner>/<repo>/<tag>/<path>
+#   github.com/<owner>/<repo>/releases/download/<tag>/<asset>
+#
+# Responses use HTTP/1.1 keep-alive and carry ETags. Map the host names to
+# the server with `usocket.HOSTS` (see `emulator.serve_github`).
+
+import hashlib
+import http.server
+import io
+import json
+import tarfile
+import threading
+from urllib.parse import unquote, urlsplit
+
+API_HOST = 'api.github.com'
+RAW_HOST = 'raw.githubusercontent.com'
+WEB_HOST = 'github.com'
+
+
+def git_blob_sha(data):
+    return hashlib.sha1(b'blob %d\x00' % len(data) + data).hexdigest()
+
+
+def make_bundle(files, prefix='', compress=True):
+    # A release asset holding `files` ({path: bytes}) as a (gzipped) tarball
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode='w:gz' if compress else 'w',
+                      format=tarfile.GNU_FORMAT) as tar:
+        for path, data in sorted(files.items()):
+            info = tarfile.TarInfo(prefix + path)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return out.getvalue()
+
+
+class Release:
+
+    def __init__(self, tag, files, assets=None):
+        self.tag = tag
+        # {path: bytes}, paths relative to the repository root
+        self.files = files
+        # {name: bytes}
+        self.assets = assets or {}
+
+    def dirs(self):
+        dirs = set()
+        for path in self.files:
+            parts = path.split('/')[:-1]
+            for i in range(len(parts)):
+                dirs.add('/'.join(parts[:i + 1]))
+        return sorted(dirs)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b'', content_type='application/json', headers=()):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            status, body = 304, b''
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if status in (200, 304):
+            self.send_header('ETag', etag)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        stub = self.server.stub
+        with stub.lock:
+            stub.requests += 1
+        host = self.headers.get('Host', '').split(':')[0]
+        url = urlsplit(self.path)
+        path = [unquote(p) for p in url.path.strip('/').split('/')]
+        try:
+            if host == RAW_HOST:
+                self._raw(stub, path)
+            elif host == WEB_HOST:
+                self._web(stub, path)
+            else:
+                self._api(stub, path, url.query)
+        except KeyError:
+            self._send(404, {'message': 'Not Found'})
+
+    do_HEAD = do_GET
+
+    def _api(self, stub, path, query):
+        if path[0] != 'repos':
+            raise KeyError(path[0])
+        repo = stub.repos[(path[1], path[2])]
+        route = path[3:]
+        if route == ['releases', 'latest']:
+            self._send(200, self._release_json(repo[-1]))
+        elif route[:2] == ['releases', 'tags']:
+            self._send(200, self._release_json(self._find(repo, route[2])))
+        elif route[:2] == ['git', 'trees']:
+            release = self._find(repo, route[2])
+            tree = [{'path': d, 'type': 'tree', 'sha': hashlib.sha1(d.encode()).hexdigest()}
+                    for d in release.dirs()]
+            tree += [{'path': p, 'type': 'blob', 'sha': git_blob_sha(data), 'size': len(data)}
+                     for p, data in sorted(release.files.items())]
+            self._send(200, {'sha': release.tag, 'tree': tree, 'truncated': False})
+        elif route[0] == 'contents':
+            tag = query.split('ref=')[-1].split('refs/tags/')[-1]
+            release = self._find(repo, tag)
+            directory = '/'.join(route[1:])
+            prefix = directory + '/' if directory else ''
+            entries = {}
+            for p in release.files:
+                if p.startswith(prefix):
+                    name = p[len(prefix):].split('/')[0]
+                    full = prefix + name
+                    entries[name] = {'name': name, 'path': full,
+                                     'type': 'file' if full in release.files else 'dir'}
+            for entry in entries.values():
+                if entry['type'] == 'file':
+                    entry['download_url'] = 'https://%s/%s/%s/%s/%s' % (
+                        RAW_HOST, path[1], path[2], release.tag, entry['path'])
+            if not entries:
+                raise KeyError(directory)
+            self._send(200, sorted(entries.values(), key=lambda e: e['name']))
+        else:
+            raise KeyError(route)
+
+    def _raw(self, stub, path):
+        release = self._find(stub.repos[(path[0], path[1])], path[2])
+        self._send(200, release.files['/'.join(path[3:])], 'application/octet-stream')
+
+    def _web(self, stub, path):
+        # Asset downloads redirect to a storage host, as on GitHub
+        release = self._find(stub.repos[(path[0], path[1])], path[4])
+        name = path[5]
+        if len(path) > 6 and path[6] == 'blob':
+            self._send(200, release.assets[name], 'application/octet-stream')
+        else:
+            release.assets[name]
+            self._send(302, headers=[('Location', '/%s/blob' % '/'.join(path))])
+
+    def _find(self, repo, tag):
+        for release in repo:
+            if release.tag == tag:
+                return release
+        raise KeyError(tag)
+
+    def _release_json(self, release):
+        owner_repo = [k for k, v in self.server.stub.repos.items() if release in v][0]
+        assets = [{'name': name, 'size': len(data),
+                   'browser_download_url': 'https://%s/%s/%s/releases/download/%s/%s' % (
+                       WEB_HOST, owner_repo[0], owner_repo[1], release.tag, name)}
+                  for name, data in sorted(release.assets.items())]
+        return {'tag_name': release.tag, 'name': release.tag, 'assets': assets}
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class GitHubStub:
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self._server = _Server((host, port), _Handler)
+        self._server.stub = self
+        self.address = self._server.server_address
+        # (owner, repo) -> [Release, ...], oldest first
+        self.repos = {}
+        self.lock = threading.Lock()
+        # Number of requests served, for benchmarks
+        self.requests = 0
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_release(self, owner, repo, tag, files, assets=None):
+        release = Release(tag, files, assets)
+        self.repos.setdefault((owner, repo), []).append(release)
+        return release
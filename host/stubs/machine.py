@@ -0,0 +1,51 @@
+# Stand-in for MicroPython's `machine` module
+
+import sys
+import threading
+import time
+
+# Set by the harness to tell devices apart
+UNIQUE_ID = b'\x24\x6f\x28\x9a\xbc\xde'
+
+# Number of times `reset()` was called
+resets = 0
+
+
+def unique_id():
+    return UNIQUE_ID
+
+
+def freq():
+    return 240000000
+
+
+def reset():
+    # There is no board to reset; stop the calling thread instead
+    global resets
+    resets += 1
+    print('machine.reset()', file=sys.stderr)
+    raise SystemExit('machine.reset()')
+
+
+def soft_reset():
+    reset()
+
+
+class WDT:
+    # Never resets anything; `expired()` tells whether a real one would have
+
+    def __init__(self, id=0, timeout=5000):
+        self.timeout = timeout
+        self.feeds = 0
+        self._last_feed = time.monotonic()
+        self._thread = threading.get_ident()
+
+    def feed(self):
+        # As on the ESP32, where the watchdog is per task
+        if threading.get_ident() != self._thread:
+            raise OSError('WDT fed from another thread')
+        self.feeds += 1
+        self._last_feed = time.monotonic()
+
+    def expired(self):
+        return (time.monotonic() - self._last_feed) * 1000 > self.timeout
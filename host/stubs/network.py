@@ -0,0 +1,42 @@
+# Stand-in for MicroPython's `network` module. The host's own network is
+# used, so the interface connects as soon as `connect()` is called unless
+# `available` is set to False.
+
+STA_IF = 0
+AP_IF = 1
+
+# Set to False to emulate an access point that is out of range
+available = True
+
+
+class WLAN:
+
+    def __init__(self, interface=STA_IF):
+        self.interface = interface
+        self._active = False
+        self._connected = False
+
+    def active(self, is_active=None):
+        if is_active is None:
+            return self._active
+        self._active = is_active
+        if not is_active:
+            self._connected = False
+
+    def connect(self, ssid=None, password=None):
+        self._connected = self._active and available
+
+    def disconnect(self):
+        self._connected = False
+
+    def isconnected(self):
+        return self._connected and available
+
+    def ifconfig(self):
+        return ('127.0.0.1', '255.0.0.0', '127.0.0.1', '127.0.0.1')
+
+    def config(self, *args, **kwargs):
+        return None
+
+    def status(self, *args):
+        return 1010 if self.isconnected() else 1000
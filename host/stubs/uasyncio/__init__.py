@@ -0,0 +1,77 @@
+# Stand-in for MicroPython's `uasyncio` on top of CPython's asyncio.
+#
+# The supervisor creates one event loop, runs it in a background thread and
+# keeps adding tasks to it from the main thread, so the loop returned by
+# `get_event_loop` wakes up when a task is created from another thread.
+
+import asyncio as _asyncio
+from asyncio import (CancelledError, Event, Lock, TimeoutError, create_task,
+                     gather, sleep, wait_for)
+
+import usocket
+
+from . import core
+
+_loop = None
+
+
+class _Loop(_asyncio.SelectorEventLoop):
+
+    def create_task(self, coro, **kwargs):
+        task = super().create_task(coro, **kwargs)
+        # Wake the selector in case the loop runs in another thread
+        self._write_to_self()
+        return task
+
+
+def get_event_loop(runq_len=0, waitq_len=0):
+    global _loop
+    if _loop is None:
+        _loop = _Loop()
+        _asyncio.set_event_loop(_loop)
+    return _loop
+
+
+new_event_loop = get_event_loop
+
+
+def run(coro):
+    return get_event_loop().run_until_complete(coro)
+
+
+async def sleep_ms(ms):
+    await sleep(ms / 1000)
+
+
+def wait_for_ms(aw, timeout):
+    return wait_for(aw, timeout / 1000)
+
+
+class ThreadSafeFlag:
+    # Event that can be set from any thread and clears itself when a waiting
+    # task is woken
+
+    def __init__(self):
+        self._event = Event()
+
+    def set(self):
+        loop = get_event_loop()
+        if loop.is_running():
+            loop.call_soon_threadsafe(self._event.set)
+        else:
+            self._event.set()
+
+    def clear(self):
+        self._event.clear()
+
+    async def wait(self):
+        await self._event.wait()
+        self._event.clear()
+
+
+async def open_connection(host, port, ssl=None):
+    # Hosts served by a local stub are reached in plain text
+    if host in usocket.HOSTS:
+        host, port = usocket.HOSTS[host]
+        ssl = None
+    return await _asyncio.open_connection(host, port, ssl=ssl or None)
@@ -0,0 +1,25 @@
+# Just enough of `uasyncio.core` for `_io_queue.queue_read(sock)`, which the
+# supervisor yields from a generator to wait until a socket is readable
+
+
+class _IOQueue:
+
+    def queue_read(self, sock):
+        from . import get_event_loop
+        loop = get_event_loop()
+        future = loop.create_future()
+        fd = sock.fileno()
+
+        def ready():
+            loop.remove_reader(fd)
+            if not future.done():
+                future.set_result(None)
+
+        loop.add_reader(fd, ready)
+        # Lets a Task wait on the future when it is yielded from a plain
+        # generator (see `emulator.install`)
+        future._asyncio_future_blocking = True
+        return future
+
+
+_io_queue = _IOQueue()
@@ -0,0 +1,3 @@
+# MicroPython's `logging` package has the same interface (and the same
+# default format) as the parts of CPython's used by the supervisor
+from logging import *
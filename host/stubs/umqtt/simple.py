@@ -0,0 +1,180 @@
+# Stand-in for `umqtt.simple`: an MQTT 3.1.1 client with the same interface,
+# using CPython sockets. Only QoS 0 and 1 are supported.
+
+import socket
+import struct
+
+import usocket
+
+
+class MQTTException(Exception):
+    pass
+
+
+class MQTTClient:
+
+    def __init__(self, client_id, server, port=0, user=None, password=None,
+                 keepalive=0, ssl=False, ssl_params={}):
+        self.client_id = client_id
+        self.server = server
+        self.port = port or 1883
+        self.user = user
+        self.password = password
+        self.keepalive = keepalive
+        self.sock = None
+        self.cb = None
+        self.pid = 0
+        self.lw_topic = None
+        self.lw_msg = None
+        self.lw_qos = 0
+        self.lw_retain = False
+        # Publish counters, for benchmarks
+        self.published = 0
+        self.published_bytes = 0
+
+    def _read(self, n):
+        data = b''
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                raise OSError(-1)
+            data += chunk
+        return data
+
+    @staticmethod
+    def _str(s):
+        if isinstance(s, str):
+            s = s.encode()
+        return struct.pack('!H', len(s)) + s
+
+    @staticmethod
+    def _packet(header, body):
+        length = bytearray()
+        n = len(body)
+        while True:
+            byte = n & 0x7f
+            n >>= 7
+            length.append(byte | 0x80 if n else byte)
+            if not n:
+                break
+        return bytes((header,)) + bytes(length) + body
+
+    def _recv_len(self):
+        n = 0
+        shift = 0
+        while True:
+            b = self._read(1)[0]
+            n |= (b & 0x7f) << shift
+            if not b & 0x80:
+                return n
+            shift += 7
+
+    def set_callback(self, f):
+        self.cb = f
+
+    def set_last_will(self, topic, msg, retain=False, qos=0):
+        self.lw_topic = topic
+        self.lw_msg = msg
+        self.lw_qos = qos
+        self.lw_retain = retain
+
+    def connect(self, clean_session=True):
+        host, port = self.server, self.port
+        if host in usocket.HOSTS:
+            host, port = usocket.HOSTS[host]
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        flags = 0x02 if clean_session else 0
+        payload = self._str(self.client_id)
+        if self.lw_topic:
+            flags |= 0x04 | (self.lw_qos & 1) << 3 | (self.lw_qos & 2) << 3 | self.lw_retain << 5
+            payload += self._str(self.lw_topic) + self._str(self.lw_msg)
+        if self.user is not None:
+            flags |= 0x80
+            payload += self._str(self.user)
+            if self.password is not None:
+                flags |= 0x40
+                payload += self._str(self.password)
+        body = self._str('MQTT') + bytes((4, flags)) + struct.pack('!H', self.keepalive) + payload
+        self.sock.sendall(self._packet(0x10, body))
+
+        resp = self._read(4)
+        if resp[0] != 0x20 or resp[1] != 0x02:
+            raise MQTTException('Unexpected CONNACK')
+        if resp[3] != 0:
+            raise MQTTException(resp[3])
+        return resp[2] & 1
+
+    def disconnect(self):
+        try:
+            self.sock.sendall(b'\xe0\x00')
+        finally:
+            self.sock.close()
+            self.sock = None
+
+    def ping(self):
+        self.sock.sendall(b'\xc0\x00')
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        if isinstance(msg, str):
+            msg = msg.encode()
+        body = self._str(topic)
+        if qos > 0:
+            self.pid += 1
+            body += struct.pack('!H', self.pid)
+        self.sock.sendall(self._packet(0x30 | qos << 1 | retain, body + msg))
+        self.published += 1
+        self.published_bytes += len(msg)
+        if qos == 1:
+            while True:
+                op = self.wait_msg()
+                if op == 0x40:
+                    self._read(3)
+                    return
+
+    def subscribe(self, topic, qos=0):
+        assert self.cb is not None, 'Subscribe callback is not set'
+        self.pid += 1
+        body = struct.pack('!H', self.pid) + self._str(topic) + bytes((qos,))
+        self.sock.sendall(self._packet(0x82, body))
+        while True:
+            op = self.wait_msg()
+            if op == 0x90:
+                resp = self._read(4)
+                if resp[3] == 0x80:
+                    raise MQTTException(resp[3])
+                return
+
+    def wait_msg(self):
+        # Handles one incoming packet. Returns None for PUBLISH and PINGRESP,
+        # otherwise the packet type for the caller to read the rest.
+        try:
+            res = self.sock.recv(1)
+        except BlockingIOError:
+            return None
+        finally:
+            self.sock.setblocking(True)
+        if res == b'':
+            raise OSError(-1)
+        if res == b'\xd0':
+            self._read(1)
+            return None
+        op = res[0]
+        if op & 0xf0 != 0x30:
+            return op
+        size = self._recv_len()
+        topic_len = struct.unpack('!H', self._read(2))[0]
+        topic = self._read(topic_len)
+        size -= topic_len + 2
+        if op & 6:
+            pid = struct.unpack('!H', self._read(2))[0]
+            size -= 2
+        msg = self._read(size)
+        self.cb(topic, msg)
+        if op & 6 == 2:
+            self.sock.sendall(b'\x40\x02' + struct.pack('!H', pid))
+
+    def check_msg(self):
+        self.sock.setblocking(False)
+        return self.wait_msg()
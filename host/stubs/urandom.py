@@ -0,0 +1 @@
+from random import choice, getrandbits, randint, random, randrange, seed, uniform
@@ -0,0 +1,85 @@
+# Stand-in for MicroPython's `usocket` module. Sockets are streams with
+# `read`/`readinto`/`readline`/`write`, as on the device.
+#
+# `HOSTS` maps host names to local `(address, port)` pairs, so requests for
+# e.g. api.github.com can be served by a stub server.
+
+import socket as _socket
+
+AF_INET = _socket.AF_INET
+SOCK_STREAM = _socket.SOCK_STREAM
+SOCK_DGRAM = _socket.SOCK_DGRAM
+IPPROTO_TCP = _socket.IPPROTO_TCP
+SOL_SOCKET = _socket.SOL_SOCKET
+SO_REUSEADDR = _socket.SO_REUSEADDR
+
+HOSTS = {}
+
+# Number of connections opened, for benchmarks
+connections = 0
+
+
+def getaddrinfo(host, port, af=0, type=0, proto=0, flags=0):
+    if host in HOSTS:
+        host, port = HOSTS[host]
+    return _socket.getaddrinfo(host, port, af, type or SOCK_STREAM, proto, flags)
+
+
+class socket:
+
+    def __init__(self, af=AF_INET, type=SOCK_STREAM, proto=0, sock=None):
+        self._sock = sock if sock is not None else _socket.socket(af, type, proto)
+        self._file = None
+
+    def connect(self, address):
+        global connections
+        connections += 1
+        self._sock.connect(address)
+
+    def _stream(self):
+        if self._file is None:
+            self._file = self._sock.makefile('rb')
+        return self._file
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self._sock.sendall(data)
+        return len(data)
+
+    send = write
+
+    # Like MicroPython's blocking streams, reads return fewer bytes than
+    # asked for only at the end of the stream
+
+    def read(self, n=-1):
+        return self._stream().read(n)
+
+    def readinto(self, buf, n=-1):
+        if n >= 0:
+            buf = memoryview(buf)[:n]
+        return self._stream().readinto(buf)
+
+    def readline(self):
+        return self._stream().readline()
+
+    def recv(self, n):
+        return self._sock.recv(n)
+
+    def setblocking(self, flag):
+        self._sock.setblocking(flag)
+
+    def settimeout(self, value):
+        self._sock.settimeout(value)
+
+    def setsockopt(self, *args):
+        self._sock.setsockopt(*args)
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._sock.close()
@@ -0,0 +1,13 @@
+# Stand-in for MicroPython's `ussl` module. Connections to hosts served by a
+# local stub (see `usocket.HOSTS`) stay in plain text.
+
+import ssl as _ssl
+
+import usocket
+
+
+def wrap_socket(sock, server_side=False, server_hostname=None, **kwargs):
+    if server_hostname in usocket.HOSTS:
+        return sock
+    context = _ssl.create_default_context()
+    return usocket.socket(sock=context.wrap_socket(sock._sock, server_hostname=server_hostname))
@@ -0,0 +1,33 @@
+# Stand-in for MicroPython's `uzlib` module (only `DecompIO`)
+
+import io
+import zlib
+
+
+class DecompIO:
+
+    def __init__(self, stream, wbits=0):
+        # MicroPython only reads from objects with the stream protocol, which
+        # Python classes get by subclassing `io.IOBase`
+        if not isinstance(stream, io.IOBase):
+            raise TypeError('stream operation not supported')
+        self._stream = stream
+        self._d = zlib.decompressobj(wbits)
+        self._pending = b''
+
+    def read(self, n=-1):
+        while n < 0 or len(self._pending) < n:
+            chunk = self._stream.read(1024)
+            if not chunk:
+                self._pending += self._d.flush()
+                break
+            self._pending += self._d.decompress(chunk)
+        if n < 0:
+            n = len(self._pending)
+        data, self._pending = self._pending[:n], self._pending[n:]
+        return data
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
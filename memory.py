@@ -0,0 +1,84 @@
+import gc
+import time
+
+
+class MemoryManager:
+    # Decides when to collect garbage, so callers don't each run a full
+    # collection (several ms on a small heap) on every pass of their loop.
+    #
+    # `maybe_collect()` collects only once `budget` bytes have been
+    # allocated since the last collection or less than `watermark` bytes are
+    # free. `gc.threshold` is set to `threshold` bytes as a backstop, so
+    # MicroPython collects by itself if the allocation between two calls
+    # gets out of hand. By default these are 1/16, 1/8 and 1/4 of the heap.
+
+    def __init__(self, budget=None, watermark=None, threshold=None):
+        self.heap_size = gc.mem_free() + gc.mem_alloc()
+        self.collections = 0
+        self.last_pause_us = 0
+        self.max_pause_us = 0
+        self.total_pause_us = 0
+        self._alloc_after_collect = gc.mem_alloc()
+        self.configure(budget, watermark, threshold)
+
+    def configure(self, budget=None, watermark=None, threshold=None):
+        self.budget = budget if budget is not None else self.heap_size // 16
+        self.watermark = watermark if watermark is not None else self.heap_size // 8
+        self.threshold = threshold if threshold is not None else self.heap_size // 4
+        gc.threshold(self.threshold)
+
+    def due(self):
+        alloc = gc.mem_alloc()
+        if alloc < self._alloc_after_collect:
+            # Collected automatically since; count from here
+            self._alloc_after_collect = alloc
+        return (alloc - self._alloc_after_collect >= self.budget or
+                self.heap_size - alloc < self.watermark)
+
+    def maybe_collect(self):
+        # Returns True if a collection was run
+        if not self.due():
+            return False
+        self.collect()
+        return True
+
+    def collect(self):
+        start = time.ticks_us()
+        gc.collect()
+        pause = time.ticks_diff(time.ticks_us(), start)
+        self._alloc_after_collect = gc.mem_alloc()
+        self.collections += 1
+        self.last_pause_us = pause
+        self.total_pause_us += pause
+        if pause > self.max_pause_us:
+            self.max_pause_us = pause
+        return pause
+
+    def stats(self):
+        alloc = gc.mem_alloc()
+        return {'heap_size': self.heap_size,
+                'free': self.heap_size - alloc,
+                'allocated_since_collect': max(0, alloc - self._alloc_after_collect),
+                'collections': self.collections,
+                'last_pause_us': self.last_pause_us,
+                'max_pause_us': self.max_pause_us,
+                'mean_pause_us': self.total_pause_us // self.collections if self.collections else 0,
+                'budget': self.budget,
+                'watermark': self.watermark,
+                'threshold': self.threshold}
+
+
+def largest_free_block(granularity=256, limit=65536):
+    # Size of the largest block that can be allocated right now, to within a
+    # factor of two, up to `limit`. MicroPython has no direct way to ask, so
+    # this tries ever smaller allocations; each failed try costs a
+    # collection, so only call it now and then. `limit` keeps the probe from
+    # briefly taking the whole heap from other threads.
+    size = min(gc.mem_free(), limit)
+    while size >= granularity:
+        try:
+            bytearray(size)
+            return size
+        except MemoryError:
+            size //= 2
+    return 0
@@ -0,0 +1,149 @@
+import time
+
+import uasyncio as asyncio
+
+# Upper bounds (in ms) of the histogram buckets; the last bucket holds
+# everything above
+BOUNDS_MS = (1, 4, 16, 64, 256, 1024, 4096, 16384, 65536)
+
+
+class Histogram:
+
+    def __init__(self, bounds=BOUNDS_MS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        i = 0
+        for bound in self.bounds:
+            if value < bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def as_dict(self):
+        return {'n': self.count, 'sum': self.total, 'max': self.max, 'buckets': self.counts}
+
+
+class LoopStats:
+    # Timing of a service's `loop()`: how long each call took (`loop`), how
+    # much of that it spent running rather than waiting (`busy`), and the
+    # longest it ran without yielding to other tasks (`max_step_us`)
+
+    def __init__(self, name):
+        self.name = name
+        self.loop = Histogram()
+        self.busy = Histogram()
+        self.max_step_us = 0
+
+    def timed(self, coro, monitor=None):
+        # `monitor.enter(name)` and `monitor.leave(name, step_us)` are called
+        # around each step; if `leave` raises, `coro` is closed
+        return _Timed(coro, self, monitor)
+
+    def as_dict(self):
+        return {'loop_ms': self.loop.as_dict(),
+                'busy_ms': self.busy.as_dict(),
+                'max_step_ms': self.max_step_us // 1000}
+
+
+class _Timed:
+    # Awaitable running `coro` one step at a time (as `await coro` would),
+    # timing each step
+
+    def __init__(self, coro, stats, monitor):
+        self._coro = coro
+        self._stats = stats
+        self._monitor = monitor
+
+    def __await__(self):
+        coro = self._coro
+        monitor = self._monitor
+        name = self._stats.name
+        start = time.ticks_ms()
+        busy = 0
+        longest = 0
+        value = None
+        error = None
+        while True:
+            if monitor is not None:
+                monitor.enter(name)
+            step_start = time.ticks_us()
+            try:
+                if error is None:
+                    yielded = coro.send(value)
+                else:
+                    yielded = coro.throw(error)
+                result = None
+                done = False
+            except StopIteration as e:
+                result = e.value
+                done = True
+            finally:
+                step = time.ticks_diff(time.ticks_us(), step_start)
+                busy += step
+                if step > longest:
+                    longest = step
+            if monitor is not None:
+                try:
+                    monitor.leave(name, step)
+                except Exception as e:
+                    if done:
+                        raise
+                    # `yielded` already queued the task to run again; hand it
+                    # to the loop and stop `coro` once the task is resumed
+                    try:
+                        yield yielded
+                    finally:
+                        coro.close()
+                    raise e
+            if done:
+                break
+            try:
+                value = yield yielded
+                error = None
+            except BaseException as e:
+                # e.g. the task was cancelled; let `coro` handle it
+                value = None
+                error = e
+
+        stats = self._stats
+        stats.loop.record(time.ticks_diff(time.ticks_ms(), start))
+        stats.busy.record(busy // 1000)
+        if longest > stats.max_step_us:
+            stats.max_step_us = longest
+        return result
+
+    __iter__ = __await__
+
+
+class Metrics:
+    # Counters collected across the supervisor; see `Service.metrics`
+
+    def __init__(self):
+        # How much later than scheduled a sleeping task wakes up
+        self.loop_lag = Histogram()
+        # From receiving a command to publishing its response
+        self.command_latency = Histogram()
+        self.dropped_commands = 0
+        self.published = 0
+        self.published_bytes = 0
+        self.services = {}
+
+    def service(self, name):
+        if name not in self.services:
+            self.services[name] = LoopStats(name)
+        return self.services[name]
+
+    async def measure_loop_lag(self, interval_ms=100):
+        while True:
+            start = time.ticks_ms()
+            await asyncio.sleep_ms(interval_ms)
+            self.loop_lag.record(max(0, time.ticks_diff(time.ticks_ms(), start) - interval_ms))
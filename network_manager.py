@@ -0,0 +1,80 @@
+import time
+import urandom
+
+import uasyncio as asyncio
+
+
+class NetworkManager:
+    # Keeps a WLAN interface connected from an asyncio task. Connection
+    # attempts never block the event loop, failed attempts are retried with
+    # exponential backoff plus jitter (so a fleet doesn't retry in lockstep
+    # after an outage), and `connected` is an Event that services can await.
+
+    def __init__(self, wlan, ssid, password, connect_timeout=10,
+                 min_backoff=1, max_backoff=60, check_interval=5):
+        self.wlan = wlan
+        self.ssid = ssid
+        self.password = password
+        self.connect_timeout = connect_timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.check_interval = check_interval
+        self.connected = asyncio.Event()
+        self.attempts = 0
+
+    def isconnected(self):
+        return self.wlan.isconnected()
+
+    async def wait_connected(self, timeout=None):
+        # Returns True once connected, or False after `timeout` seconds
+        if self.wlan.isconnected():
+            return True
+        # `run()` may not have noticed yet that the connection dropped
+        self.connected.clear()
+        if timeout is None:
+            await self.connected.wait()
+            return True
+        try:
+            await asyncio.wait_for(self.connected.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _connect(self):
+        print('Connecting to network...')
+        self.attempts += 1
+        self.wlan.active(True)
+        self.wlan.connect(self.ssid, self.password)
+
+        start_time = time.ticks_ms()
+        while (not self.wlan.isconnected() and
+               time.ticks_diff(time.ticks_ms(), start_time) < self.connect_timeout * 1000):
+            await asyncio.sleep_ms(100)
+
+        if self.wlan.isconnected():
+            print('Network config:', self.wlan.ifconfig())
+            return True
+        return False
+
+    async def run(self):
+        backoff = self.min_backoff
+        while True:
+            if self.wlan.isconnected():
+                self.connected.set()
+                backoff = self.min_backoff
+                await asyncio.sleep(self.check_interval)
+                continue
+
+            self.connected.clear()
+            if await self._connect():
+                continue
+
+            # Wait somewhere between 0.5x and 1.5x the current backoff (in ms)
+            delay = backoff * (512 + urandom.getrandbits(10))
+            print("Can't connect to network, retrying in %dms" % delay)
+            try:
+                self.wlan.disconnect()
+            except OSError:
+                pass
+            await asyncio.sleep_ms(delay)
+            backoff = min(backoff * 2, self.max_backoff)
@@ -2,10 +2,14 @@
 # ohja, en er is ook nog tante suker (Jana Dej.) die graag kinderen wilt maar het zelf nog niet beseft
 
 import usocket
+import io
 import os
 import gc
+import time
+import sys
 import machine
 
+import uasyncio as asyncio
 import ulogging as logging
 
 logger = logging.getLogger('supervisor')
@@ -52,18 +56,59 @@ class Version:
 
 
 class OTAUpdater:
-    def __init__(self, github_repo, module_path, remote_module_path=''):
-        self.http_client = HttpClient()
+    def __init__(self, github_repo, module_path, remote_module_path='', chunk_size=1024,
+                 http_client=None, delta=True, bundle=None, window_bits=15,
+                 mpy_bundle=None, check_interval=0):
+        # Pass a shared `HttpClient` to reuse keep-alive connections across
+        # several updaters
+        self.http_client = http_client if http_client is not None else HttpClient()
         self.github_repo = github_repo.rstrip('/').replace('https://github.com', 'https://api.github.com/repos')
+        self.raw_url = self.github_repo.replace('https://api.github.com/repos', 'https://raw.githubusercontent.com')
         self.remote_module_path = remote_module_path
         self.module_path = module_path
         self.modules_dir = '/'.join(module_path.split('/')[:-1])
         self.module_name = module_path.split('/')[-1]
         self.update_path = self.modules_dir + '/.' + self.module_name + '_update'
+        # Reused for every file download so peak memory doesn't depend on
+        # the size of the files being updated
+        self._chunk_buf = bytearray(chunk_size)
+        # Only download files whose hash differs from the installed version
+        self.delta = delta
+        # Name of a release asset (`.tar`, `.tar.gz` or `.tgz`) holding the
+        # whole module. `window_bits` must not be smaller than the deflate
+        # window the bundle was compressed with; smaller windows need less RAM.
+        self.bundle = bundle
+        self.window_bits = window_bits
+        # Local copy of the `bundle` asset to unpack instead of downloading
+        # it, e.g. one fetched from peers (see `peer.py`)
+        self.bundle_file = None
+        # Name of a release asset with precompiled `.mpy` files, where `%d` is
+        # replaced by the firmware's bytecode version (e.g. `foo-mpy%d.tar.gz`)
+        self.mpy_bundle = mpy_bundle
+        # Minimum number of seconds between two checks for a new version
+        self.check_interval = check_interval
+        self.last_check_path = self.modules_dir + '/.' + self.module_name + '_last_check'
 
     def check_for_update_to_install_during_next_reboot(self):
+        if not self.is_check_due():
+            return None
+        return self._stage_update(self.get_latest_version())
+
+    async def check_for_update_async(self, http_client):
+        # Same as `check_for_update_to_install_during_next_reboot`, but looks
+        # up the latest version with an `AsyncHttpClient` so that several
+        # services can be checked concurrently
+        if not self.is_check_due():
+            return None
+        return self._stage_update(await self.get_latest_version_async(http_client))
+
+    def check_for_update_from(self, version):
+        # Stage `version` if it's newer than the installed one, for versions
+        # learned of other than from GitHub (e.g. announced by a peer)
+        return self._stage_update(version)
+
+    def _stage_update(self, latest_version):
         current_version = self.get_version(self.module_path)
-        latest_version = self.get_latest_version()
 
         logger.info('Checking version... ')
         logger.info('\tCurrent version: %s' % current_version)
@@ -88,27 +133,49 @@ class OTAUpdater:
             logger.info('No new updates found...')
 
     def _download_and_install_update(self, latest_version):
-        self.download_all_files(self.github_repo + '/contents/', latest_version)
+        self.download_release(latest_version)
         self.rmtree(self.module_path)
         os.rename(self.update_path + '/.version_on_reboot', self.update_path + '/.version')
         os.rename(self.update_path, self.module_path)
         logger.info('Update installed (%s)' % latest_version)
 
     def apply_pending_updates_if_available(self):
-        if (self.module_name + '_update') in os.listdir(self.modules_path):
-            if '.version' in os.listdir(self.update_path):
+        # Install an update downloaded earlier (see
+        # `download_pending_update_async`). Returns True if one was applied.
+        if self.update_path.split('/')[-1] in os.listdir(self.modules_dir):
+            files = os.listdir(self.update_path)
+            if '.version' in files:
                 pending_update_version = self.get_version(self.update_path)
                 logger.info('Pending update found: %s' % pending_update_version)
-                self.rmtree(self.module_path)
+                if self.module_name in os.listdir(self.modules_dir):
+                    self.rmtree(self.module_path)
                 os.rename(self.update_path, self.module_path)
                 logger.info('Update applied (%s), ready to rock and roll' % pending_update_version)
+                return True
+            elif '.version_on_reboot' in files:
+                logger.info('Pending update not downloaded yet')
             else:
                 logger.error('Corrupt pending update found, discarding...')
                 self.rmtree(self.update_path)
         else:
             logger.info('No pending update found')
+        return False
+
+    async def download_pending_update_async(self, pause_ms=100):
+        # Download the version staged by a check into the update directory
+        # without installing it, pausing `pause_ms` between files so other
+        # tasks keep running. Renaming `.version_on_reboot` to `.version`
+        # marks the download as complete.
+        latest_version = self.get_version(self.update_path, '.version_on_reboot')
+        logger.info('Downloading update: %s' % latest_version)
+        for step in self._download_release_steps(latest_version):
+            await asyncio.sleep_ms(pause_ms)
+        os.rename(self.update_path + '/.version_on_reboot', self.update_path + '/.version')
+        logger.info('Update downloaded (%s), pending install' % latest_version)
 
     def download_updates_if_available(self):
+        if not self.is_check_due():
+            return False
         current_version = self.get_version(self.module_path)
         latest_version = self.get_latest_version()
 
@@ -118,7 +185,7 @@ class OTAUpdater:
         if latest_version > current_version:
             logger.info('Updating...')
             os.mkdir(self.update_path)
-            self.download_all_files(self.github_repo + '/contents/' + self.remote_module_path, latest_version)
+            self.download_release(latest_version)
             with open(self.update_path + '/.version', 'w') as versionfile:
                 versionfile.write(latest_version)
 
@@ -143,20 +210,276 @@ class OTAUpdater:
             return version
         return 'v0.0'
 
+    def is_check_due(self):
+        if not self.check_interval:
+            return True
+        try:
+            with open(self.last_check_path) as f:
+                last_check = int(f.read())
+        except (OSError, ValueError):
+            return True
+        elapsed = time.time() - last_check
+        # A negative value means the clock was reset, so we can't tell
+        if 0 <= elapsed < self.check_interval:
+            logger.info('Last checked %ds ago, skipping check' % elapsed)
+            return False
+        return True
+
     def get_latest_version(self):
-        latest_release = self.http_client.get(self.github_repo + '/releases/latest')
+        latest_release = self.http_client.get(self.github_repo + '/releases/latest', use_cache=True)
         version = latest_release.json()['tag_name']
         latest_release.close()
+        self._checked()
         return version
 
+    async def get_latest_version_async(self, http_client):
+        latest_release = await http_client.get(self.github_repo + '/releases/latest')
+        version = latest_release.json()['tag_name']
+        latest_release.close()
+        self._checked()
+        return version
+
+    def _checked(self):
+        if self.check_interval:
+            with open(self.last_check_path, 'w') as f:
+                f.write(str(time.time()))
+
+    def download_release(self, version):
+        for step in self._download_release_steps(version):
+            pass
+
+    def _download_release_steps(self, version):
+        # Generator doing the download in steps (roughly one per file)
+        if not (self.bundle and self.download_bundle(version)):
+            yield from self._download_tree_steps(version)
+        if self.mpy_bundle:
+            self.download_bytecode(version)
+
+    def download_bytecode(self, version):
+        # Overlay the update with `.mpy` files built for this firmware's
+        # bytecode version, if the release has them
+        mpy = mpy_version()
+        if mpy is None:
+            return False
+        name = self.mpy_bundle % mpy
+        bundle, bundle_file = self.bundle, self.bundle_file
+        self.bundle, self.bundle_file = name, None
+        try:
+            if not self.download_bundle(version):
+                return False
+        finally:
+            self.bundle, self.bundle_file = bundle, bundle_file
+        use_bytecode(self.update_path, mpy)
+        return True
+
+    def get_asset_url(self, version, name):
+        # Not cached: every release has its own URL, so entries for
+        # superseded releases would pile up on flash
+        response = self.http_client.get(self.github_repo + '/releases/tags/' + version)
+        try:
+            if response.status_code != 200:
+                return None
+            for asset in iter_json_objects(response.iter_content(buf=self._chunk_buf), 3):
+                if asset.get('name') == name and 'browser_download_url' in asset:
+                    return asset['browser_download_url']
+        finally:
+            response.close()
+            gc.collect()
+        return None
+
+    def download_bundle(self, version):
+        # Download the release asset `bundle` and unpack it into the update
+        # directory as it streams in. Returns False if the release has no
+        # such asset.
+        if self.bundle_file is not None:
+            logger.info('\tUnpacking bundle: %s' % self.bundle_file)
+            with open(self.bundle_file, 'rb') as f:
+                self._unpack_bundle(f)
+            return True
+
+        url = self.get_asset_url(version, self.bundle)
+        if url is None:
+            logger.info('No %s asset for %s' % (self.bundle, version))
+            return False
+
+        logger.info('\tDownloading bundle: %s' % self.bundle)
+        response = self.http_client.get(url)
+        try:
+            if response.status_code != 200:
+                raise OSError('Failed to download %s (%d)' % (self.bundle, response.status_code))
+            self._unpack_bundle(response)
+        finally:
+            response.close()
+            gc.collect()
+        return True
+
+    def _unpack_bundle(self, stream):
+        if self.bundle.endswith('.gz') or self.bundle.endswith('.tgz'):
+            stream = gunzip(stream, self.window_bits)
+        prefix = self.remote_module_path + '/' if self.remote_module_path else ''
+        untar(stream, self.update_path, prefix, self._chunk_buf)
+
+    def download_bundle_file(self, version, path):
+        # Download the release asset `bundle` to `path` as is, e.g. to pass
+        # it on to peers. Returns False if the release has no such asset.
+        url = self.get_asset_url(version, self.bundle)
+        if url is None:
+            logger.info('No %s asset for %s' % (self.bundle, version))
+            return False
+
+        logger.info('\tDownloading: %s' % path)
+        response = self.http_client.get(url)
+        try:
+            if response.status_code != 200:
+                raise OSError('Failed to download %s (%d)' % (self.bundle, response.status_code))
+            with open(path, 'wb') as outfile:
+                for chunk in response.iter_content(buf=self._chunk_buf):
+                    outfile.write(chunk)
+        finally:
+            response.close()
+            gc.collect()
+        return True
+
+    def write_download_plan(self, version, plan_path):
+        # Fetch the whole tree for `version` in a single request and write the
+        # entries under `remote_module_path` to `plan_path`, one
+        # `<type> <sha> <relative path>` line per entry. Entries are parsed
+        # one at a time, so the listing never has to fit in memory. Returns
+        # False if GitHub truncated the listing.
+        response = self.http_client.get(self.github_repo + '/git/trees/' + version + '?recursive=1')
+        top = bytearray()
+        prefix = self.remote_module_path + '/' if self.remote_module_path else ''
+        try:
+            # e.g. rate limited; an error body would parse as an empty tree
+            if response.status_code != 200:
+                raise OSError('Failed to list %s (%d)' % (version, response.status_code))
+            with open(plan_path, 'w') as plan:
+                for entry in iter_json_objects(response.iter_content(buf=self._chunk_buf), 3, top):
+                    path = entry['path']
+                    if entry['type'] not in ('blob', 'tree') or not path.startswith(prefix):
+                        continue
+                    plan.write('%s %s %s\n' % (entry['type'], entry['sha'], path[len(prefix):]))
+        finally:
+            response.close()
+            gc.collect()
+        import ujson
+        return not ujson.loads(bytes(top)).get('truncated', False)
+
+    def download_tree(self, version):
+        for step in self._download_tree_steps(version):
+            pass
+
+    def _download_tree_steps(self, version):
+        plan_path = self.update_path + '/.plan'
+        if not self.write_download_plan(version, plan_path):
+            logger.info('Tree listing truncated, walking directories instead')
+            os.remove(plan_path)
+            self.download_all_files(self.github_repo + '/contents/' + self.remote_module_path, version)
+            return
+
+        installed = self.get_manifest() if self.delta else {}
+        prefix = self.raw_url + '/' + version + '/'
+        if self.remote_module_path:
+            prefix += self.remote_module_path + '/'
+        with open(plan_path) as plan:
+            for line in plan:
+                kind, sha, path = line.rstrip('\n').split(' ', 2)
+                if kind == 'tree':
+                    try:
+                        os.mkdir(self.update_path + '/' + path)
+                    except OSError:
+                        pass
+                elif installed.get(path) == sha:
+                    logger.info('\tUnchanged: %s' % path)
+                    self.copy_file(self.module_path + '/' + path, self.update_path + '/' + path)
+                else:
+                    self.download_file(prefix + path, self.update_path + '/' + path)
+                    yield
+        installed = None
+
+        # The plan lists the git blob hash of every file in the new version,
+        # so it becomes the manifest of the update once it is installed
+        os.rename(plan_path, self.update_path + '/.manifest')
+
+    def get_manifest(self):
+        # Map of relative path -> git blob sha for the installed version.
+        # Computed from the files on flash the first time and cached in
+        # `.manifest` next to `.version`.
+        if self.module_name not in os.listdir(self.modules_dir):
+            return {}
+        manifest_path = self.module_path + '/.manifest'
+        try:
+            os.stat(manifest_path)
+        except OSError:
+            try:
+                with open(manifest_path, 'w') as manifest:
+                    self._write_manifest(self.module_path, '', manifest)
+            except Exception as e:
+                # e.g. no uhashlib.sha1 on this port; download everything
+                logger.error('Could not compute manifest: %s' % repr(e))
+                try:
+                    os.remove(manifest_path)
+                except OSError:
+                    pass
+                return {}
+
+        hashes = {}
+        with open(manifest_path) as manifest:
+            for line in manifest:
+                kind, sha, path = line.rstrip('\n').split(' ', 2)
+                if kind == 'blob':
+                    hashes[path] = sha
+        return hashes
+
+    def _write_manifest(self, directory, prefix, manifest):
+        for entry in os.ilistdir(directory):
+            if entry[0].startswith('.'):
+                continue
+            path = prefix + entry[0]
+            if entry[1] == 0x4000:
+                manifest.write('tree - %s\n' % path)
+                self._write_manifest(directory + '/' + entry[0], path + '/', manifest)
+            else:
+                manifest.write('blob %s %s\n' % (self.git_blob_sha(directory + '/' + entry[0]), path))
+
+    def git_blob_sha(self, path):
+        # Same hash git (and so the trees API) uses for file contents
+        import uhashlib
+        import ubinascii
+        h = uhashlib.sha1(b'blob %d\x00' % os.stat(path)[6])
+        with open(path, 'rb') as f:
+            while True:
+                n = f.readinto(self._chunk_buf)
+                if not n:
+                    break
+                h.update(memoryview(self._chunk_buf)[:n])
+        return ubinascii.hexlify(h.digest()).decode()
+
+    def copy_file(self, src, dst):
+        try:
+            os.stat(src)
+        except OSError:
+            # Source hidden in favour of its bytecode by `use_bytecode`
+            src += '.src'
+        with open(src, 'rb') as infile:
+            with open(dst, 'wb') as outfile:
+                while True:
+                    n = infile.readinto(self._chunk_buf)
+                    if not n:
+                        break
+                    outfile.write(memoryview(self._chunk_buf)[:n])
+
     def download_all_files(self, root_url, version):
         file_list = self.http_client.get(root_url + '?ref=refs/tags/' + version)
+        if file_list.status_code != 200:
+            file_list.close()
+            raise OSError('Failed to list %s (%d)' % (root_url, file_list.status_code))
         for file in file_list.json():
             if self.remote_module_path in file['path']:
                 if file['type'] == 'file':
                     download_url = file['download_url']
                     download_path = self.update_path + '/' + file['path'].replace(self.remote_module_path + '/', '')
-                    self.download_file(download_url.replace('refs/tags/', ''), download_path)
+                    self.download_file(download_url, download_path)
                 elif file['type'] == 'dir':
                     if file['path'] != self.remote_module_path:
                         path = self.update_path + '/' + file['path'].replace(self.remote_module_path + '/', '')
@@ -166,26 +489,249 @@ class OTAUpdater:
 
     def download_file(self, url, path):
         logger.info('\tDownloading: %s' % path)
-        with open(path, 'w') as outfile:
+        response = self.http_client.get(url)
+        try:
+            if response.status_code != 200:
+                raise OSError('Failed to download %s (%d)' % (path, response.status_code))
+            with open(path, 'wb') as outfile:
+                for chunk in response.iter_content(buf=self._chunk_buf):
+                    outfile.write(chunk)
+        finally:
+            response.close()
+            gc.collect()
+
+
+def iter_json_objects(chunks, depth, top=None):
+    # Incrementally parse a JSON document arriving as byte `chunks`, yielding
+    # each object nested `depth` levels deep (e.g. depth 3 for the entries of
+    # `{"tree": [{...}, ...]}`) as soon as it is complete. Only one object is
+    # buffered at a time. If `top` is a bytearray, the enclosing document is
+    # collected into it with the nested containers left empty, so it can be
+    # parsed afterwards for small top-level fields.
+    import ujson
+    level = 0
+    in_string = False
+    escape = False
+    obj = bytearray()
+    for chunk in chunks:
+        for c in chunk:
+            before = level
+            if in_string:
+                if escape:
+                    escape = False
+                elif c == 0x5c:  # \
+                    escape = True
+                elif c == 0x22:  # "
+                    in_string = False
+            elif c == 0x22:
+                in_string = True
+            elif c == 0x7b or c == 0x5b:  # { [
+                level += 1
+            elif c == 0x7d or c == 0x5d:  # } ]
+                level -= 1
+
+            if before >= depth or level >= depth:
+                obj.append(c)
+                if level < depth:
+                    yield ujson.loads(bytes(obj))
+                    obj = bytearray()
+            elif top is not None and min(before, level) < depth - 1:
+                top.append(c)
+
+
+def mpy_version():
+    # Bytecode version of `.mpy` files this firmware can import, or None if it
+    # can't import them at all
+    try:
+        return sys.implementation._mpy & 0xff
+    except AttributeError:
+        return None
+
+
+def _walk_files(directory):
+    for entry in os.ilistdir(directory):
+        path = directory + '/' + entry[0]
+        if entry[1] == 0x4000:
+            for f in _walk_files(path):
+                yield f
+        else:
+            yield path
+
+
+def use_bytecode(directory, version):
+    # MicroPython imports `x.py` in preference to `x.mpy`, so move the source
+    # of every module that has bytecode next to it out of the way (to
+    # `x.py.src`) and record which bytecode version was installed
+    for path in list(_walk_files(directory)):
+        if path.endswith('.mpy'):
             try:
-                response = self.http_client.get(url)
-                outfile.write(response.text)
-            finally:
-                response.close()
-                outfile.close()
-                gc.collect()
+                os.rename(path[:-4] + '.py', path[:-4] + '.py.src')
+            except OSError:
+                pass
+    with open(directory + '/.mpy_version', 'w') as f:
+        f.write(str(version))
+
+
+def check_bytecode(directory):
+    # Fall back to the sources if the installed `.mpy` files were built for a
+    # different bytecode version than this firmware's (e.g. after a firmware
+    # upgrade). Returns True if bytecode is in use.
+    try:
+        with open(directory + '/.mpy_version') as f:
+            installed = int(f.read())
+    except (OSError, ValueError):
+        return False
+    if installed == mpy_version():
+        return True
+
+    logger.info('%s has bytecode v%d, firmware needs v%s; using sources' %
+                (directory, installed, mpy_version()))
+    for path in list(_walk_files(directory)):
+        if path.endswith('.py.src'):
+            os.rename(path, path[:-4])
+            try:
+                os.remove(path[:-7] + '.mpy')
+            except OSError:
+                pass
+    os.remove(directory + '/.mpy_version')
+    return False
+
 
+def gunzip(stream, window_bits=15):
+    # Decompress a gzip stream on the fly with a `2**window_bits` byte window
+    try:
+        import deflate
+        return deflate.DeflateIO(stream, deflate.GZIP, window_bits)
+    except ImportError:
+        import uzlib
+        return uzlib.DecompIO(stream, 16 + window_bits)
 
-class Response:
 
-    def __init__(self, f):
+def _readinto_exactly(stream, buf):
+    mv = memoryview(buf)
+    n = 0
+    while n < len(buf):
+        r = stream.readinto(mv[n:])
+        if not r:
+            break
+        n += r
+    return n
+
+
+def _makedirs(path):
+    parent = ''
+    for part in path.split('/'):
+        parent = parent + '/' + part if parent else part
+        try:
+            os.mkdir(parent)
+        except OSError:
+            pass
+
+
+def untar(stream, dest, prefix='', buf=None):
+    # Minimal streaming tar reader: extracts regular files and directories
+    # from `stream` into `dest`, reading through `buf` so memory use does not
+    # depend on the archive size. A leading `./` and `prefix` are stripped
+    # from member names; members outside `prefix`, with absolute paths or
+    # with `..` in their path are skipped. Supports
+    # ustar name prefixes, GNU long names and pax `path` records.
+    if buf is None:
+        buf = bytearray(512)
+    header = bytearray(512)
+    long_name = None
+    while _readinto_exactly(stream, header) == 512 and header[0]:
+        size = int(bytes(header[124:136]).rstrip(b'\x00 ') or b'0', 8)
+        kind = header[156]
+        if long_name is not None:
+            name = long_name
+            long_name = None
+        else:
+            name = bytes(header[:100]).split(b'\x00', 1)[0]
+            if header[257:262] == b'ustar' and header[345]:
+                name = bytes(header[345:500]).split(b'\x00', 1)[0] + b'/' + name
+            name = name.decode()
+
+        if kind in (0x4c, 0x78):  # 'L' GNU long name, 'x' pax header
+            data = bytearray(size)
+            _readinto_exactly(stream, data)
+            _skip(stream, -size % 512, header)
+            if kind == 0x4c:
+                long_name = bytes(data).split(b'\x00', 1)[0].decode()
+            else:
+                for record in bytes(data).decode().split('\n'):
+                    if ' path=' in record:
+                        long_name = record.split(' path=', 1)[1]
+            continue
+
+        if name.startswith('./'):
+            name = name[2:]
+        name = name.rstrip('/')
+        if prefix and (name + '/').startswith(prefix):
+            name = name[len(prefix):]
+            wanted = True
+        else:
+            wanted = not prefix
+        # Never write outside `dest`
+        if name.startswith('/') or '..' in name.split('/'):
+            wanted = False
+
+        if wanted and name and kind == 0x35:  # '5' directory
+            _makedirs(dest + '/' + name)
+        elif wanted and name and kind in (0, 0x30):  # regular file
+            if '/' in name:
+                _makedirs(dest + '/' + name.rsplit('/', 1)[0])
+            with open(dest + '/' + name, 'wb') as outfile:
+                left = size
+                mv = memoryview(buf)
+                while left:
+                    n = _readinto_exactly(stream, mv[:min(left, len(buf))])
+                    if not n:
+                        raise OSError('Truncated archive')
+                    outfile.write(mv[:n])
+                    left -= n
+            _skip(stream, -size % 512, header)
+            continue
+        _skip(stream, size + -size % 512, header)
+
+
+def _skip(stream, n, buf):
+    mv = memoryview(buf)
+    while n:
+        r = _readinto_exactly(stream, mv[:min(n, len(buf))])
+        if not r:
+            raise OSError('Truncated archive')
+        n -= r
+
+
+# Subclassing `io.IOBase` gives the class the stream protocol, which
+# `deflate.DeflateIO`/`uzlib.DecompIO` need to read from it (see `gunzip`)
+class Response(io.IOBase):
+
+    def __init__(self, f, length=None, client=None, key=None, chunked=False):
         self.raw = f
         self.encoding = 'utf-8'
         self._cached = None
+        # Number of body bytes still to be read from `raw` (in the current
+        # chunk for chunked responses), or `None` if the body is delimited by
+        # the server closing the connection
+        self._remaining = 0 if chunked else length
+        # True until the terminating chunk of a chunked body has been read
+        self._chunked = chunked
+        self._chunk_started = False
+        # Connection pool the socket is returned to once the body is consumed
+        self._client = client
+        self._key = key
+        self.etag = None
+        self.last_modified = None
+        self.from_cache = False
 
     def close(self):
         if self.raw:
-            self.raw.close()
+            if (self._client is not None and self._remaining == 0
+                    and not self._chunked):
+                self._client._release(self._key, self.raw)
+            else:
+                self.raw.close()
             self.raw = None
         self._cached = None
 
@@ -193,24 +739,193 @@ class Response:
     def content(self):
         if self._cached is None:
             try:
-                self._cached = self.raw.read()
+                content = self.read()
             finally:
-                self.raw.close()
-                self.raw = None
+                self.close()
+            self._cached = content
         return self._cached
 
     @property
     def text(self):
         return str(self.content, self.encoding)
 
+    def read(self, size=-1):
+        if self._remaining is None:
+            return self.raw.read() if size < 0 else self.raw.read(size)
+        if size < 0:
+            chunks = []
+            while True:
+                self._next_chunk()
+                if not self._remaining:
+                    break
+                chunk = self.read(self._remaining)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            return b''.join(chunks)
+        self._next_chunk()
+        size = min(size, self._remaining or 0)
+        if not size:
+            return b''
+        data = self.raw.read(size)
+        self._consumed(len(data))
+        return data
+
+    def readinto(self, buf):
+        if self._remaining is None:
+            return self.raw.readinto(buf)
+        self._next_chunk()
+        if not self._remaining:
+            return 0
+        if len(buf) > self._remaining:
+            buf = memoryview(buf)[:self._remaining]
+        n = self.raw.readinto(buf)
+        self._consumed(n or 0)
+        return n
+
+    def _next_chunk(self):
+        # Start reading the next chunk of a chunked body once the current one
+        # has been consumed. Only the size line is held in memory, so chunks
+        # of any size are streamed with the caller's buffer.
+        if not self._chunked or self._remaining:
+            return
+        if self._chunk_started:
+            # CRLF terminating the previous chunk's data
+            self.raw.readline()
+        self._chunk_started = True
+        l = self.raw.readline()
+        if not l:
+            self._consumed(0)
+            return
+        size = int(l.split(b';', 1)[0].strip(), 16)
+        if size:
+            self._remaining = size
+            return
+        # Last chunk; skip any trailers
+        while True:
+            l = self.raw.readline()
+            if not l or l == b'\r\n':
+                break
+        self._chunked = False
+
+    def _consumed(self, n):
+        if n:
+            self._remaining -= n
+        else:
+            # The server closed the connection before sending the whole body;
+            # don't let a partial file pass for a complete one
+            self._client = None
+            raise OSError('Truncated response')
+
+    def iter_content(self, chunk_size=1024, buf=None):
+        # Stream the body through a single preallocated buffer. Each chunk is
+        # a memoryview into that buffer, so it is only valid until the next
+        # iteration; copy it (e.g. `bytes(chunk)`) if it needs to be kept.
+        if buf is None:
+            buf = bytearray(chunk_size)
+        mv = memoryview(buf)
+        try:
+            while True:
+                n = self.readinto(buf)
+                if not n:
+                    break
+                yield mv[:n]
+        finally:
+            self.close()
+
     def json(self):
         import ujson
         return ujson.loads(self.content)
 
 
-class HttpClient:
+class HttpCache:
+    # Persistent cache of GET responses on flash, keyed by URL. Cached entries
+    # are revalidated with If-None-Match/If-Modified-Since, so an unchanged
+    # resource costs a 304 with no body instead of a full download. Entries
+    # are never evicted, so only cache URLs that don't change per release.
 
-    def request(self, method, url, data=None, json=None, headers={}, stream=None):
+    def __init__(self, directory='.http_cache'):
+        self.directory = directory
+        try:
+            os.mkdir(directory)
+        except OSError:
+            pass
+
+    def _path(self, url):
+        try:
+            import uhashlib
+            import ubinascii
+            key = ubinascii.hexlify(uhashlib.sha1(url.encode()).digest()[:8]).decode()
+        except (ImportError, AttributeError):
+            key = '%08x' % (hash(url) & 0xffffffff)
+        return self.directory + '/' + key
+
+    def _meta(self, url):
+        import ujson
+        try:
+            with open(self._path(url) + '.json') as f:
+                meta = ujson.load(f)
+        except (OSError, ValueError):
+            return None
+        # Guard against key collisions
+        return meta if meta.get('url') == url else None
+
+    def validators(self, url):
+        meta = self._meta(url)
+        if meta is None:
+            return None
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def open(self, url):
+        path = self._path(url)
+        resp = Response(open(path, 'rb'), os.stat(path)[6])
+        resp.status_code = 200
+        resp.reason = 'OK'
+        resp.from_cache = True
+        return resp
+
+    def store(self, url, resp):
+        # Write the body of `resp` to the cache and return a response that
+        # reads it back from flash
+        import ujson
+        path = self._path(url)
+        try:
+            os.remove(path + '.json')
+        except OSError:
+            pass
+        try:
+            with open(path, 'wb') as f:
+                for chunk in resp.iter_content():
+                    f.write(chunk)
+        except:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            raise
+        with open(path + '.json', 'w') as f:
+            ujson.dump({'url': url, 'etag': resp.etag,
+                        'last_modified': resp.last_modified}, f)
+        return self.open(url)
+
+
+class AsyncHttpClient:
+    # Minimal HTTP/1.0 client on uasyncio streams for small requests (e.g.
+    # version lookups) that must not block the event loop. Bodies are read
+    # into memory, so use `HttpClient` to stream large downloads. HTTPS needs
+    # a firmware whose `open_connection` supports `ssl` (v1.21+).
+
+    def __init__(self, cache=None, timeout=30):
+        # GET responses are revalidated against this `HttpCache`, if given
+        self.cache = cache
+        self.timeout = timeout
+
+    async def request(self, method, url, headers={}, max_redirects=5):
         try:
             proto, dummy, host, path = url.split('/', 3)
         except ValueError:
@@ -219,70 +934,293 @@ class HttpClient:
         if proto == 'http:':
             port = 80
         elif proto == 'https:':
-            import ussl
             port = 443
         else:
             raise ValueError('Unsupported protocol: ' + proto)
 
+        netloc = host
         if ':' in host:
             host, port = host.split(':', 1)
             port = int(port)
 
-        ai = usocket.getaddrinfo(host, port, 0, usocket.SOCK_STREAM)
-        ai = ai[0]
+        cache = self.cache if method == 'GET' else None
+        # Validators only apply to `url`, not to where it may redirect to
+        request_headers = headers
+        if cache is not None:
+            validators = cache.validators(url)
+            if validators:
+                headers = dict(headers)
+                headers.update(validators)
 
-        s = usocket.socket(ai[0], ai[1], ai[2])
+        if proto == 'https:':
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port, ssl=True), self.timeout)
+        else:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port), self.timeout)
         try:
-            s.connect(ai[-1])
-            if proto == 'https:':
-                s = ussl.wrap_socket(s, server_hostname=host)
-            s.write(b'%s /%s HTTP/1.0\r\n' % (method, path))
+            request = '%s /%s HTTP/1.0\r\n' % (method, path)
             if not 'Host' in headers:
-                s.write(b'Host: %s\r\n' % host)
-            # Iterate over keys to avoid tuple alloc
+                request += 'Host: %s\r\n' % host
             for k in headers:
-                s.write(k)
-                s.write(b': ')
-                s.write(headers[k])
-                s.write(b'\r\n')
-            # add user agent
-            s.write('User-Agent')
-            s.write(b': ')
-            s.write('MicroPython OTAUpdater')
-            s.write(b'\r\n')
-            if json is not None:
-                assert data is None
-                import ujson
-                data = ujson.dumps(json)
-                s.write(b'Content-Type: application/json\r\n')
-            if data:
-                s.write(b'Content-Length: %d\r\n' % len(data))
-            s.write(b'\r\n')
-            if data:
-                s.write(data)
-
-            l = s.readline()
-            l = l.split(None, 2)
+                request += '%s: %s\r\n' % (k, headers[k])
+            request += 'User-Agent: MicroPython OTAUpdater\r\n\r\n'
+            writer.write(request.encode())
+            await writer.drain()
+
+            l = (await asyncio.wait_for(reader.readline(), self.timeout)).split(None, 2)
             status = int(l[1])
             reason = ''
             if len(l) > 2:
                 reason = l[2].rstrip()
+            length = None
+            location = None
+            etag = None
+            last_modified = None
             while True:
-                l = s.readline()
+                l = await asyncio.wait_for(reader.readline(), self.timeout)
                 if not l or l == b'\r\n':
                     break
-                if l.startswith(b'Transfer-Encoding:'):
-                    if b'chunked' in l:
-                        raise ValueError('Unsupported ' + l)
-                elif l.startswith(b'Location:') and not 200 <= status <= 299:
-                    raise NotImplementedError('Redirects not yet supported')
+                name = l.lower()
+                if name.startswith(b'content-length:'):
+                    length = int(l[15:])
+                elif name.startswith(b'location:'):
+                    location = l[9:].strip().decode()
+                elif name.startswith(b'etag:'):
+                    etag = l[5:].strip().decode()
+                elif name.startswith(b'last-modified:'):
+                    last_modified = l[14:].strip().decode()
+
+            if method == 'HEAD' or status in (204, 304):
+                body = b''
+            elif length is not None:
+                body = await asyncio.wait_for(reader.readexactly(length), self.timeout)
+            else:
+                body = await asyncio.wait_for(reader.read(-1), self.timeout)
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
+        if location is not None and status in (301, 302, 303, 307, 308):
+            if not max_redirects:
+                raise ValueError('Too many redirects')
+            if location.startswith('/'):
+                location = '%s//%s%s' % (proto, netloc, location)
+            if status == 303:
+                method = 'GET'
+            return await self.request(method, location, headers=request_headers,
+                                      max_redirects=max_redirects - 1)
+
+        resp = Response(io.BytesIO(body), len(body))
+        resp.status_code = status
+        resp.reason = reason
+        resp.etag = etag
+        resp.last_modified = last_modified
+
+        if cache is not None:
+            if status == 304:
+                return cache.open(url)
+            if status == 200 and (etag or last_modified):
+                return cache.store(url, resp)
+        return resp
+
+    async def get(self, url, **kw):
+        return await self.request('GET', url, **kw)
+
+
+class HttpClient:
+
+    def __init__(self, max_connections_per_host=1, idle_timeout=30, cache=None):
+        self.max_connections_per_host = max_connections_per_host
+        # `HttpCache` used for requests made with `use_cache=True`
+        self.cache = cache
+        self.idle_timeout_ms = idle_timeout * 1000
+        # Idle keep-alive connections: (proto, host, port) -> [(socket, last_used), ...]
+        self._pool = {}
+
+    def _acquire(self, key):
+        connections = self._pool.get(key)
+        while connections:
+            s, last_used = connections.pop()
+            if time.ticks_diff(time.ticks_ms(), last_used) < self.idle_timeout_ms:
+                return s
+            s.close()
+        return None
+
+    def _release(self, key, s):
+        connections = self._pool.setdefault(key, [])
+        if len(connections) < self.max_connections_per_host:
+            connections.append((s, time.ticks_ms()))
+        else:
+            s.close()
+
+    def close(self):
+        for connections in self._pool.values():
+            for s, last_used in connections:
+                s.close()
+        self._pool = {}
+
+    def _connect(self, proto, host, port):
+        ai = usocket.getaddrinfo(host, port, 0, usocket.SOCK_STREAM)
+        ai = ai[0]
+
+        s = usocket.socket(ai[0], ai[1], ai[2])
+        try:
+            s.connect(ai[-1])
+            if proto == 'https:':
+                import ussl
+                s = ussl.wrap_socket(s, server_hostname=host)
         except OSError:
             s.close()
             raise
+        return s
+
+    def request(self, method, url, data=None, json=None, headers={}, stream=None,
+                max_redirects=5, use_cache=False):
+        try:
+            proto, dummy, host, path = url.split('/', 3)
+        except ValueError:
+            proto, dummy, host = url.split('/', 2)
+            path = ''
+        if proto == 'http:':
+            port = 80
+        elif proto == 'https:':
+            port = 443
+        else:
+            raise ValueError('Unsupported protocol: ' + proto)
+
+        netloc = host
+        if ':' in host:
+            host, port = host.split(':', 1)
+            port = int(port)
+
+        if json is not None:
+            assert data is None
+            import ujson
+            data = ujson.dumps(json)
 
-        resp = Response(s)
+        cache = self.cache if use_cache and method == 'GET' else None
+        # Validators only apply to `url`, not to where it may redirect to
+        request_headers = headers
+        if cache is not None:
+            validators = cache.validators(url)
+            if validators:
+                headers = dict(headers)
+                headers.update(validators)
+
+        key = (proto, host, port)
+        while True:
+            s = self._acquire(key)
+            reused = s is not None
+            if not reused:
+                s = self._connect(proto, host, port)
+            try:
+                s.write('%s /%s HTTP/1.1\r\n' % (method, path))
+                if not 'Host' in headers:
+                    s.write('Host: %s\r\n' % host)
+                # Iterate over keys to avoid tuple alloc
+                for k in headers:
+                    s.write(k)
+                    s.write(b': ')
+                    s.write(headers[k])
+                    s.write(b'\r\n')
+                # add user agent
+                s.write('User-Agent')
+                s.write(b': ')
+                s.write('MicroPython OTAUpdater')
+                s.write(b'\r\n')
+                if json is not None:
+                    s.write(b'Content-Type: application/json\r\n')
+                if data:
+                    s.write('Content-Length: %d\r\n' % len(data))
+                s.write(b'\r\n')
+                if data:
+                    s.write(data)
+
+                l = s.readline()
+                if not l:
+                    raise OSError('Connection closed by server')
+                l = l.split(None, 2)
+                keep_alive = l[0] == b'HTTP/1.1'
+                status = int(l[1])
+                reason = ''
+                if len(l) > 2:
+                    reason = l[2].rstrip()
+                length = None
+                chunked = False
+                location = None
+                etag = None
+                last_modified = None
+                while True:
+                    l = s.readline()
+                    if not l or l == b'\r\n':
+                        break
+                    # Match names case-insensitively but keep values as sent
+                    name = l.lower()
+                    if name.startswith(b'content-length:'):
+                        length = int(l[15:])
+                    elif name.startswith(b'connection:'):
+                        keep_alive = b'keep-alive' in name
+                    elif name.startswith(b'transfer-encoding:'):
+                        chunked = b'chunked' in name
+                    elif name.startswith(b'location:'):
+                        location = l[9:].strip().decode()
+                    elif name.startswith(b'etag:'):
+                        etag = l[5:].strip().decode()
+                    elif name.startswith(b'last-modified:'):
+                        last_modified = l[14:].strip().decode()
+            except OSError:
+                s.close()
+                # A pooled connection may have been dropped by the server
+                # while it was idle, so retry once on a fresh one
+                if reused:
+                    continue
+                raise
+            except:
+                s.close()
+                raise
+            break
+
+        if method == 'HEAD' or status in (204, 304) or 100 <= status <= 199:
+            length = 0
+            chunked = False
+        if length is None and not chunked:
+            # Body runs until the server closes the connection
+            keep_alive = False
+
+        resp = Response(s, length, self if keep_alive else None, key, chunked)
         resp.status_code = status
         resp.reason = reason
+        resp.etag = etag
+        resp.last_modified = last_modified
+
+        if location is not None and status in (301, 302, 303, 307, 308):
+            if not max_redirects:
+                resp.close()
+                raise ValueError('Too many redirects')
+            # Drain a short body so the connection can be reused if the
+            # redirect points back at the same host
+            if keep_alive and (chunked or length <= 1024):
+                resp.read()
+            resp.close()
+            if location.startswith('/'):
+                location = '%s//%s%s' % (proto, netloc, location)
+            if status == 303 or (status in (301, 302) and method == 'POST'):
+                method = 'GET'
+                data = json = None
+            if json is not None:
+                data = None
+            return self.request(method, location, data=data, json=json, headers=request_headers,
+                                stream=stream, max_redirects=max_redirects - 1,
+                                use_cache=use_cache)
+
+        if cache is not None:
+            if status == 304:
+                resp.close()
+                return cache.open(url)
+            if status == 200 and (etag or last_modified):
+                return cache.store(url, resp)
+
         return resp
 
     def head(self, url, **kw):
@@ -0,0 +1,253 @@
+import os
+import struct
+import time
+
+import uasyncio as asyncio
+import ubinascii
+import uhashlib
+import ujson as json
+import ulogging as logging
+import urandom
+
+logger = logging.getLogger('peer')
+
+# Chunk messages start with the chunk's sequence number and the first four
+# bytes of the bundle's SHA-256, so chunks of another release published on
+# the same topic are ignored
+HEADER_SIZE = 8
+
+# How often a seeder publishes its manifest again, e.g. for receivers that
+# gave up or a broker that restarted without keeping retained messages
+MANIFEST_INTERVAL_MS = 600000
+
+
+def sha256_file(path, buf):
+    h = uhashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(memoryview(buf)[:n])
+    return ubinascii.hexlify(h.digest()).decode()
+
+
+def make_manifest(path, version, chunk_size=1024):
+    size = os.stat(path)[6]
+    return {'version': version,
+            'size': size,
+            'chunk_size': chunk_size,
+            'chunks': (size + chunk_size - 1) // chunk_size,
+            'sha256': sha256_file(path, bytearray(chunk_size))}
+
+
+def _publish(mqtt, topic, msg, retain=False):
+    # Without reconnecting and retrying, which would block the event loop
+    # until the broker is back; callers try again later instead
+    publish = getattr(mqtt, 'publish_once', None)
+    if publish is None:
+        publish = mqtt.publish
+    publish(topic, msg, retain)
+
+
+def _tag(manifest):
+    return ubinascii.unhexlify(manifest['sha256'][:8])
+
+
+# Bitmaps of chunks, one bit each
+def _get(bits, i):
+    return bits[i >> 3] & (1 << (i & 7))
+
+
+def _set(bits, i):
+    bits[i >> 3] |= 1 << (i & 7)
+
+
+def _clear(bits, i):
+    bits[i >> 3] &= ~(1 << (i & 7))
+
+
+class PeerSeeder:
+    # Serves a release bundle that was downloaded once to the rest of a
+    # fleet over MQTT, so that WAN traffic doesn't grow with the fleet.
+    #
+    # The manifest (version, size, chunking and SHA-256 of the bundle) is
+    # published, retained, to `<topic>/manifest`. Receivers ask for the
+    # chunks they are missing on `<topic>/requests` and all of them get the
+    # chunks on `<topic>/chunks`, so a chunk requested by many receivers at
+    # once is sent once. At most `rate` chunks are sent per 100ms, read from
+    # the file one at a time.
+
+    def __init__(self, mqtt, topic, path, manifest, rate=10):
+        self.mqtt = mqtt
+        self.topic = topic
+        self.path = path
+        self.manifest = manifest
+        self.rate = rate
+        self.requests = 0
+        self.sent_chunks = 0
+        self._pending = bytearray((manifest['chunks'] + 7) // 8)
+        self._waiting = 0
+        self._cursor = 0
+        self._tag = _tag(manifest)
+        self._buf = bytearray(HEADER_SIZE + manifest['chunk_size'])
+
+    def on_request(self, topic, message):
+        # {"id": ..., "sha256": ..., "missing": [[start, end], ...]}
+        request = json.loads(message)
+        if request.get('sha256') != self.manifest['sha256']:
+            return
+        self.requests += 1
+        chunks = self.manifest['chunks']
+        pending = self._pending
+        for start, end in request['missing']:
+            for i in range(max(0, start), min(end, chunks)):
+                if not _get(pending, i):
+                    _set(pending, i)
+                    self._waiting += 1
+
+    def stats(self):
+        return {'version': self.manifest['version'],
+                'requests': self.requests,
+                'sent_chunks': self.sent_chunks,
+                'pending_chunks': self._waiting}
+
+    async def serve(self):
+        chunks = self.manifest['chunks']
+        pending = self._pending
+        announced = None
+        with open(self.path, 'rb') as f:
+            while True:
+                try:
+                    now = time.ticks_ms()
+                    if announced is None or time.ticks_diff(now, announced) >= MANIFEST_INTERVAL_MS:
+                        _publish(self.mqtt, self.topic + '/manifest', json.dumps(self.manifest), True)
+                        announced = now
+                    for n in range(self.rate):
+                        if not self._waiting:
+                            break
+                        i = self._cursor
+                        while not _get(pending, i):
+                            i = (i + 1) % chunks
+                        _clear(pending, i)
+                        self._waiting -= 1
+                        self._cursor = (i + 1) % chunks
+                        self._send(f, i)
+                except Exception as e:
+                    # Not connected; receivers ask again for what they missed
+                    logger.error("Couldn't serve %s. %s" % (self.topic, repr(e)))
+                    await asyncio.sleep(1)
+                await asyncio.sleep_ms(100)
+
+    def _send(self, f, i):
+        buf = self._buf
+        struct.pack_into('>I', buf, 0, i)
+        buf[4:HEADER_SIZE] = self._tag
+        f.seek(i * self.manifest['chunk_size'])
+        n = f.readinto(memoryview(buf)[HEADER_SIZE:])
+        _publish(self.mqtt, self.topic + '/chunks', memoryview(buf)[:HEADER_SIZE + n])
+        self.sent_chunks += 1
+
+
+class PeerReceiver:
+    # Fetches the bundle described by `manifest` from a `PeerSeeder` into
+    # `path`. Memory use doesn't depend on the size of the bundle: each chunk
+    # is written to its place in the file as it arrives and a bitmap keeps
+    # track of the chunks received. When no chunk arrived for `timeout_ms`,
+    # the missing ones (up to `max_ranges` runs of them) are requested again;
+    # after `retries` requests in a row without any progress, `fetch()`
+    # gives up.
+
+    def __init__(self, mqtt, topic, path, manifest, client_id, timeout_ms=5000,
+                 retries=5, max_ranges=16):
+        self.mqtt = mqtt
+        self.topic = topic
+        self.path = path
+        self.manifest = manifest
+        self.client_id = client_id
+        self.timeout_ms = timeout_ms
+        self.retries = retries
+        self.max_ranges = max_ranges
+        self.received = 0
+        self.requests = 0
+        self._bits = bytearray((manifest['chunks'] + 7) // 8)
+        self._tag = _tag(manifest)
+        self._file = None
+
+    def on_chunk(self, topic, message):
+        if self._file is None or len(message) < HEADER_SIZE or message[4:HEADER_SIZE] != self._tag:
+            return
+        i = struct.unpack_from('>I', message)[0]
+        if i >= self.manifest['chunks'] or _get(self._bits, i):
+            return
+        self._file.seek(i * self.manifest['chunk_size'])
+        self._file.write(memoryview(message)[HEADER_SIZE:])
+        _set(self._bits, i)
+        self.received += 1
+
+    def missing(self):
+        # [start, end) runs of chunks not received yet
+        ranges = []
+        bits = self._bits
+        chunks = self.manifest['chunks']
+        i = 0
+        while i < chunks and len(ranges) < self.max_ranges:
+            if _get(bits, i):
+                i += 1
+                continue
+            start = i
+            while i < chunks and not _get(bits, i):
+                i += 1
+            ranges.append([start, i])
+        return ranges
+
+    def _request(self):
+        self.requests += 1
+        _publish(self.mqtt, self.topic + '/requests',
+                 json.dumps({'id': self.client_id,
+                             'sha256': self.manifest['sha256'],
+                             'missing': self.missing()}))
+
+    async def fetch(self):
+        # Returns True once the whole bundle arrived and matches its hash
+        chunk_size = self.manifest['chunk_size']
+        chunks = self.manifest['chunks']
+        buf = bytearray(chunk_size)
+        # Allocate the whole file up front, so chunks can arrive in any order
+        with open(self.path, 'wb') as f:
+            for i in range(chunks):
+                f.write(buf if i < chunks - 1 else memoryview(buf)[:self.manifest['size'] - i * chunk_size])
+
+        self._file = open(self.path, 'r+b')
+        try:
+            # Spread out the requests of devices that got the manifest at
+            # the same time
+            await asyncio.sleep_ms(urandom.getrandbits(10))
+            tries = 0
+            while self.received < chunks:
+                received = self.received
+                try:
+                    self._request()
+                except Exception as e:
+                    logger.error("Couldn't request chunks of %s. %s" % (self.topic, repr(e)))
+                idle = 0
+                while self.received < chunks and idle < self.timeout_ms:
+                    before = self.received
+                    await asyncio.sleep_ms(100)
+                    idle = 0 if self.received != before else idle + 100
+                if self.received == received:
+                    tries += 1
+                    if tries > self.retries:
+                        logger.error('No chunks of %s arrived, giving up' % self.topic)
+                        return False
+                else:
+                    tries = 0
+        finally:
+            self._file.close()
+            self._file = None
+
+        if sha256_file(self.path, buf) != self.manifest['sha256']:
+            logger.error('%s %s does not match its hash' % (self.topic, self.manifest['version']))
+            os.remove(self.path)
+            return False
+        return True
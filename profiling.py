@@ -0,0 +1,55 @@
+import gc
+import time
+
+
+class BootTimeline:
+    # Records how long each phase of startup takes and how the heap changes
+    # over it, e.g.
+    #
+    #     with timeline.phase('init_mqtt'):
+    #         ...
+    #
+    # Heap figures are taken as-is (without collecting first), so they show
+    # what a phase allocated, garbage included.
+
+    def __init__(self):
+        # ms since reset when the timeline was started
+        self.started_ms = time.ticks_ms()
+        self._start = time.ticks_us()
+        self.phases = []
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def as_dict(self):
+        return {'started_ms': self.started_ms,
+                'total_us': (self.phases[-1]['start_us'] + self.phases[-1]['us']
+                             if self.phases else 0),
+                'phases': self.phases}
+
+
+class _Phase:
+
+    def __init__(self, timeline, name):
+        self._timeline = timeline
+        self._name = name
+
+    def __enter__(self):
+        self._free = gc.mem_free()
+        self._alloc = gc.mem_alloc()
+        self._start = time.ticks_us()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.ticks_us()
+        self._timeline.phases.append({
+            'name': self._name,
+            'start_us': time.ticks_diff(self._start, self._timeline._start),
+            'us': time.ticks_diff(end, self._start),
+            'free_before': self._free,
+            'free_after': gc.mem_free(),
+            'alloc_before': self._alloc,
+            'alloc_after': gc.mem_alloc(),
+            'ok': exc_type is None,
+        })
+        return False
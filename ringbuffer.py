@@ -0,0 +1,154 @@
+import _thread
+import time
+from array import array
+
+# What `RingBuffer.write` does when there isn't enough room for new data
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+BLOCK = 'block'
+
+
+class RingBuffer:
+    # Preallocated byte ring buffer for line-oriented data (e.g. log output).
+    #
+    # Writers append with `write()`. The reader takes complete lines with
+    # `peekline()`, which returns a memoryview into the buffer (no copy unless
+    # the line wraps around the end), and releases each line with `consume()`
+    # once it is done with it. Because the view points into the buffer, the
+    # reader must hold `lock` from `peekline()` until `consume()`.
+
+    # Room for one line per this many bytes of capacity unless `max_lines`
+    # is given; each line costs 4 bytes of bookkeeping
+    BYTES_PER_LINE = 32
+
+    def __init__(self, capacity=4096, max_lines=None, overflow=DROP_OLDEST):
+        if overflow not in (DROP_OLDEST, DROP_NEWEST, BLOCK):
+            raise ValueError('Unsupported overflow policy: %s' % overflow)
+        self.capacity = capacity
+        self.overflow = overflow
+        self.lock = _thread.allocate_lock()
+        # Thread that reads lines; it is never blocked by the BLOCK policy
+        self.consumer = None
+        self.dropped_lines = 0
+        self._buf = bytearray(capacity)
+        self._mv = memoryview(self._buf)
+        # Scratch space for lines that wrap around, allocated on first use
+        self._wrapped = None
+        self._head = 0
+        self._tail = 0
+        self._size = 0
+        if max_lines is None:
+            max_lines = max(1, capacity // self.BYTES_PER_LINE)
+        # Ring of buffer offsets of the newline ending each complete line
+        self._ends = array('I', (0 for i in range(max_lines)))
+        self._ends_head = 0
+        self._ends_tail = 0
+        self._lines = 0
+        # Length of the incomplete line at the end of the buffer
+        self._partial = 0
+        # Set while discarding the rest of a line whose start was dropped
+        self._discard = False
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def lines(self):
+        return self._lines
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        with self.lock:
+            if self._discard:
+                newline = data.find(b'\n')
+                if newline == -1:
+                    return
+                self._discard = False
+                data = data[newline + 1:]
+
+            n = len(data)
+            if not n:
+                return
+            newlines = data.count(b'\n')
+
+            while (n > self.capacity - self._size or
+                   self._lines + newlines > len(self._ends)):
+                if n > self.capacity or newlines > len(self._ends):
+                    self._drop_newest(data, newlines)
+                    return
+                if self.overflow == DROP_OLDEST and self._lines:
+                    self._drop_oldest()
+                elif (self.overflow == BLOCK and self.consumer is not None
+                        and self.consumer != _thread.get_ident()):
+                    # Wait for the reader to make room
+                    self.lock.release()
+                    try:
+                        time.sleep_ms(1)
+                    finally:
+                        self.lock.acquire()
+                else:
+                    self._drop_newest(data, newlines)
+                    return
+
+            head = self._head
+            first = min(n, self.capacity - head)
+            self._mv[head:head + first] = data[:first]
+            if first < n:
+                self._mv[:n - first] = data[first:]
+
+            if newlines:
+                self._partial = n - data.rfind(b'\n') - 1
+            else:
+                self._partial += n
+
+            start = 0
+            while newlines:
+                i = data.find(b'\n', start)
+                self._ends[self._ends_head] = (head + i) % self.capacity
+                self._ends_head = (self._ends_head + 1) % len(self._ends)
+                self._lines += 1
+                newlines -= 1
+                start = i + 1
+
+            self._head = (head + n) % self.capacity
+            self._size += n
+
+    def _drop_newest(self, data, newlines):
+        self.dropped_lines += max(newlines, 1)
+        # Drop the start and the rest of a partial line too, so lines are
+        # never spliced together
+        if self._partial:
+            self._head = (self._head - self._partial) % self.capacity
+            self._size -= self._partial
+            self._partial = 0
+        self._discard = not data.endswith(b'\n')
+
+    def _drop_oldest(self):
+        self.consume()
+        self.dropped_lines += 1
+
+    def peekline(self):
+        # The oldest complete line, without its newline, or None
+        if not self._lines:
+            return None
+        tail = self._tail
+        end = self._ends[self._ends_tail]
+        if end >= tail:
+            return self._mv[tail:end]
+        # Line wraps around the end of the buffer
+        if self._wrapped is None:
+            self._wrapped = bytearray(self.capacity)
+        first = self.capacity - tail
+        self._wrapped[:first] = self._mv[tail:]
+        self._wrapped[first:first + end] = self._mv[:end]
+        return memoryview(self._wrapped)[:first + end]
+
+    def consume(self):
+        # Release the line returned by `peekline`
+        end = self._ends[self._ends_tail]
+        length = (end - self._tail) % self.capacity + 1
+        self._ends_tail = (self._ends_tail + 1) % len(self._ends)
+        self._lines -= 1
+        self._tail = (self._tail + length) % self.capacity
+        self._size -= length
@@ -0,0 +1,159 @@
+import _thread
+import time
+
+import machine
+import uasyncio as asyncio
+import ulogging as logging
+
+# What happens to a service that runs longer than its slice without yielding
+WARN = 'warn'
+THROTTLE = 'throttle'
+
+# Longest a throttled service is held back after one `loop()`
+MAX_THROTTLE_MS = 10000
+
+
+class ServiceHung(Exception):
+    pass
+
+
+class _Slot:
+
+    def __init__(self):
+        self.overruns = 0
+        # Time over the slice not yet paid back by throttling
+        self.debt_ms = 0
+        self.restarts = 0
+        self.hung = False
+        self.last_warning = None
+
+
+class Scheduler:
+    # Watches what services do with the event loop. Services' `loop()` runs
+    # one step (the code between two awaits) at a time through
+    # `LoopStats.timed`, which reports each step with `enter`/`leave`:
+    #
+    # - A step longer than `slice_ms` is an overrun. It is logged (at most
+    #   once a minute per service) and, with the THROTTLE policy, the
+    #   service sleeps for the time it took over its slices after its
+    #   `loop()` returns.
+    # - A step that takes `hang_ms` or more counts as a hang: the service's
+    #   `loop()` is cancelled and restarted as soon as the step returns (see
+    #   `BaseService.main`). `watch()`, which runs in its own thread, logs
+    #   the hang while it is still going on.
+    # - If the event loop stops running altogether, `watch()` stops feeding
+    #   the hardware watchdog (if `wdt_timeout` is set), which resets the
+    #   device `wdt_timeout` seconds later.
+
+    def __init__(self, slice_ms=100, policy=WARN, hang_ms=10000, check_ms=1000,
+                 heartbeat_ms=1000):
+        self.configure(slice_ms, policy, hang_ms)
+        self.check_ms = check_ms
+        self.heartbeat_ms = heartbeat_ms
+        self.slots = {}
+        # Service whose step is running and when it started
+        self.current = None
+        self.step_started = 0
+        self.heartbeat = time.ticks_ms()
+        self.loop_blocked = 0
+        self._suspended = 0
+        self._wdt = None
+        self._logger = logging.getLogger('scheduler')
+
+    def configure(self, slice_ms=100, policy=WARN, hang_ms=10000):
+        if policy not in (WARN, THROTTLE):
+            raise ValueError('Unsupported overrun policy: %s' % policy)
+        self.slice_ms = slice_ms
+        self.policy = policy
+        self.hang_ms = hang_ms
+
+    def slot(self, name):
+        if name not in self.slots:
+            self.slots[name] = _Slot()
+        return self.slots[name]
+
+    def enter(self, name):
+        self.step_started = time.ticks_ms()
+        self.current = name
+
+    def leave(self, name, step_us):
+        self.current = None
+        step_ms = step_us // 1000
+        if step_ms <= self.slice_ms and step_ms < self.hang_ms:
+            return
+        slot = self.slot(name)
+        # Set by `watch()` while the step was running
+        slot.hung = False
+        if step_ms >= self.hang_ms:
+            slot.restarts += 1
+            raise ServiceHung('%s blocked the event loop for %dms' % (name, step_ms))
+        slot.overruns += 1
+        slot.debt_ms += step_ms - self.slice_ms
+        now = time.ticks_ms()
+        if slot.last_warning is None or time.ticks_diff(now, slot.last_warning) >= 60000:
+            slot.last_warning = now
+            self._logger.warning('%s ran for %dms without yielding (slice is %dms, %d overruns)'
+                                 % (name, step_ms, self.slice_ms, slot.overruns))
+
+    async def throttle(self, name):
+        if self.policy != THROTTLE or name not in self.slots:
+            return
+        slot = self.slots[name]
+        if slot.debt_ms:
+            delay = min(slot.debt_ms, MAX_THROTTLE_MS)
+            slot.debt_ms = 0
+            await asyncio.sleep_ms(delay)
+
+    def suspend(self):
+        # Keep feeding the watchdog while the event loop is knowingly blocked
+        # (e.g. while installing an update) until `resume()`
+        self._suspended += 1
+
+    def resume(self):
+        self._suspended -= 1
+
+    async def beat(self):
+        while True:
+            self.heartbeat = time.ticks_ms()
+            await asyncio.sleep_ms(self.heartbeat_ms)
+
+    def start(self, wdt_timeout=0):
+        # The loop may only start running `beat()` a little later
+        self.heartbeat = time.ticks_ms()
+        asyncio.get_event_loop().create_task(self.beat())
+        _thread.start_new_thread(self.watch, (wdt_timeout,))
+
+    def watch(self, wdt_timeout=0):
+        # The ESP32's watchdog can only be fed from the thread (task) that
+        # created it
+        if wdt_timeout:
+            self._wdt = machine.WDT(timeout=wdt_timeout * 1000)
+        blocked = False
+        while True:
+            now = time.ticks_ms()
+            current = self.current
+            if (current is not None and
+                    time.ticks_diff(now, self.step_started) >= self.hang_ms):
+                slot = self.slot(current)
+                if not slot.hung:
+                    slot.hung = True
+                    self._logger.error('%s has not yielded for %dms, restarting it once it does'
+                                       % (current, self.hang_ms))
+
+            if time.ticks_diff(now, self.heartbeat) <= 2 * self.heartbeat_ms or self._suspended:
+                blocked = False
+                if self._wdt is not None:
+                    self._wdt.feed()
+            elif not blocked:
+                blocked = True
+                self.loop_blocked += 1
+                self._logger.error('Event loop blocked (running: %s)' % (current or 'supervisor'))
+
+            time.sleep_ms(self.check_ms)
+
+    def stats(self):
+        return {'slice_ms': self.slice_ms,
+                'policy': self.policy,
+                'loop_blocked': self.loop_blocked,
+                'services': {name: {'overruns': slot.overruns, 'restarts': slot.restarts}
+                             for name, slot in self.slots.items()}}
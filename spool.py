@@ -0,0 +1,143 @@
+import os
+
+
+class LogSpool:
+    # Bounded queue of unsent MQTT messages on flash.
+    #
+    # Messages are buffered in RAM and appended to numbered segment files in
+    # `directory` once `buffer_size` bytes are waiting (or on `flush()`), so
+    # each flash write is a single append. A segment is closed when it reaches
+    # `segment_size` bytes; when there are more than `segments` of them the
+    # oldest is deleted, which bounds both flash use and wear. `replay()`
+    # publishes the spooled messages again, oldest first, and saves how far
+    # it got to `offset` after each call, so that after a reset messages
+    # aren't published twice.
+
+    def __init__(self, directory='.log_spool', segment_size=4096, segments=8,
+                 buffer_size=512):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segments = segments
+        self.buffer_size = buffer_size
+        self.dropped_segments = 0
+        self._buf = bytearray()
+        try:
+            os.mkdir(directory)
+        except OSError:
+            pass
+        numbers = [int(name) for name in os.listdir(directory) if name.isdigit()]
+        # Oldest segment still to be replayed and the segment being written
+        self._first = min(numbers) if numbers else 0
+        self._last = max(numbers) if numbers else 0
+        self._offset = 0
+        # Last (segment, offset) written to `offset`
+        self._saved = None
+        try:
+            with open(directory + '/offset') as f:
+                first, offset = [int(x) for x in f.read().split()]
+            if first == self._first:
+                self._offset = offset
+                self._saved = (first, offset)
+        except (OSError, ValueError):
+            pass
+
+    def _path(self, n):
+        return '%s/%d' % (self.directory, n)
+
+    def pending(self):
+        if self._buf:
+            return True
+        if self._first < self._last:
+            return True
+        try:
+            return os.stat(self._path(self._first))[6] > self._offset
+        except OSError:
+            return False
+
+    def append(self, topic, message):
+        self._buf.extend(topic.encode())
+        self._buf.extend(b'\t')
+        self._buf.extend(message.encode())
+        self._buf.extend(b'\n')
+        if len(self._buf) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buf:
+            return
+        try:
+            size = os.stat(self._path(self._last))[6]
+        except OSError:
+            size = 0
+        if size >= self.segment_size:
+            self._last += 1
+            if self._last - self._first >= self.segments:
+                # Make room by dropping the oldest segment
+                self._remove(self._first)
+                self._first += 1
+                self._offset = 0
+                self.dropped_segments += 1
+        with open(self._path(self._last), 'ab') as f:
+            f.write(self._buf)
+        self._buf = bytearray()
+
+    def _remove(self, n):
+        try:
+            os.remove(self._path(n))
+        except OSError:
+            pass
+
+    def _save_offset(self):
+        position = (self._first, self._offset)
+        if position != self._saved:
+            with open(self.directory + '/offset', 'w') as f:
+                f.write('%d %d' % position)
+            self._saved = position
+
+    def replay(self, publish, limit=10):
+        # Publish up to `limit` spooled messages with `publish(topic, message)`,
+        # oldest first. Stops at the first failure, which is retried on the
+        # next call. Returns the number of messages published.
+        self.flush()
+        try:
+            return self._replay(publish, limit)
+        finally:
+            self._save_offset()
+
+    def _replay(self, publish, limit):
+        count = 0
+        while count < limit:
+            try:
+                f = open(self._path(self._first), 'rb')
+            except OSError:
+                if self._first >= self._last:
+                    break
+                self._first += 1
+                self._offset = 0
+                continue
+
+            with f:
+                f.seek(self._offset)
+                while count < limit:
+                    line = f.readline()
+                    if not line:
+                        break
+                    topic, message = line.rstrip(b'\n').split(b'\t', 1)
+                    publish(topic.decode(), message.decode())
+                    self._offset += len(line)
+                    count += 1
+                else:
+                    return count
+
+            # Segment fully replayed. Move on before removing it: a reset in
+            # between must not leave an offset into a segment that is then
+            # written anew.
+            n = self._first
+            self._offset = 0
+            if n < self._last:
+                self._first += 1
+            self._save_offset()
+            self._remove(n)
+            if n >= self._last:
+                break
+        return count